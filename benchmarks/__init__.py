@@ -0,0 +1,16 @@
+"""
+Бенчмарки и нагрузочные тесты бота.
+
+    python -m benchmarks                     # все наборы, отличия от baseline.json
+    python -m benchmarks --compare           # код выхода 1 при регрессии (для CI)
+    python -m benchmarks db prompt           # только выбранные наборы
+    python -m benchmarks --save-baseline     # записать результаты как новый baseline
+    python -m benchmarks.fake_openrouter     # заглушка OpenRouter и Telegram отдельно
+
+Импорт пакета готовит окружение для bot.py (токен-заглушка, временная БД,
+метрики выключены), поэтому bot импортируется только после него.
+"""
+
+from benchmarks.common import setup_env
+
+setup_env()
@@ -0,0 +1,171 @@
+"""
+Запуск наборов бенчмарков и сравнение с сохранённым baseline.
+
+    python -m benchmarks [db] [prompt] [search] [load] [--repeat N] [--compare] [--save-baseline] [--baseline путь]
+
+Отличия от baseline печатаются всегда; с --compare (для CI) код выхода 1,
+если какая-то метрика хуже baseline больше чем на --threshold или сравнивать
+не с чем. Сравниваются только наборы, снятые на той же машине с теми же
+параметрами (они хранятся в baseline вместе с результатами).
+С --repeat каждый прогон идёт в отдельном процессе со своей БД, и по каждой
+метрике берётся лучший результат: шум машины только замедляет, поэтому
+лучший из нескольких прогонов стабильнее одного. С --compare и
+--save-baseline по умолчанию --repeat 3.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import benchmarks  # noqa: F401 — окружение для bot.py до его импорта
+import bot
+from benchmarks import db_ops, load, memory_search, prompt_assembly
+from benchmarks.common import BASELINE_PATH, best_of, load_baseline, machine_info, report, save_baseline
+
+SUITES = ("db", "prompt", "search", "load")
+# Параметры, от которых зависят результаты набора (сравнивать можно только при совпадении)
+SUITE_PARAMS = {
+    "db": ("iterations",),
+    "prompt": ("iterations",),
+    "search": ("iterations", "archived"),
+    "load": ("updates", "chats", "concurrency", "latency", "rate_429", "rate_503", "telegram_limits"),
+}
+
+
+async def main(args) -> dict:
+    bot.init_db()
+    bot.message_writer.start()
+    results = {}
+    try:
+        if "db" in args.suites:
+            print("⏱️  db ...")
+            results.update(await db_ops.run(args.iterations))
+        if "prompt" in args.suites:
+            print("⏱️  prompt ...")
+            results.update(await prompt_assembly.run(args.iterations))
+        if "search" in args.suites:
+            print("⏱️  search ...")
+            results.update(await memory_search.run(args.iterations, args.archived))
+        if "load" in args.suites:
+            print("⏱️  load ...")
+            results.update(await load.run(
+                updates=args.updates,
+                chats=args.chats,
+                concurrency=args.concurrency,
+                latency=args.latency,
+                rate_429=args.rate_429,
+                rate_503=args.rate_503,
+                telegram_limits=args.telegram_limits,
+            ))
+    finally:
+        await bot.message_writer.stop()
+        await bot.openrouter.close()
+        bot.storage.close()
+    return results
+
+
+def run_repeated(repeat: int) -> dict:
+    """Прогоняет те же наборы repeat раз в дочерних процессах (каждый со своей временной БД)"""
+    runs = []
+    for i in range(repeat):
+        print(f"🔁 Прогон {i + 1}/{repeat}")
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "results.json")
+            subprocess.run([sys.executable, "-m", "benchmarks", *sys.argv[1:]],
+                           env={**os.environ, "BENCH_OUTPUT": output}, check=True)
+            with open(output, encoding="utf-8") as f:
+                runs.append(json.load(f))
+    return best_of(runs)
+
+
+def suite_params(args) -> dict:
+    return {
+        suite: {"repeat": args.repeat, **{name: getattr(args, name) for name in SUITE_PARAMS[suite]}}
+        for suite in args.suites
+    }
+
+
+def comparable_results(baseline: dict, params: dict) -> dict:
+    """Результаты baseline для наборов, снятых на этой машине с теми же параметрами"""
+    if not baseline:
+        return {}
+    if baseline.get("machine") != machine_info():
+        print(f"⚠️  Baseline снят на другой машине ({baseline.get('machine')}), не сравниваю")
+        return {}
+    suites = []
+    for suite, wanted in params.items():
+        if baseline["params"].get(suite) == wanted:
+            suites.append(suite)
+        elif suite in baseline["params"]:
+            print(f"⚠️  {suite}: параметры отличаются от baseline ({baseline['params'][suite]}), не сравниваю")
+    return {name: metrics for name, metrics in baseline["results"].items() if name.split(".")[0] in suites}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки GhostAI")
+    parser.add_argument("suites", nargs="*", help=f"наборы: {', '.join(SUITES)} (по умолчанию все)")
+    parser.add_argument("--iterations", type=int, default=2000, help="повторов в микробенчмарках")
+    parser.add_argument("--archived", type=int, default=100_000, help="записей в архиве чата для search")
+    parser.add_argument("--updates", type=int, default=2000, help="апдейтов в нагрузочном тесте")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=100, help="апдейтов в обработке одновременно")
+    parser.add_argument("--latency", default="lognormal:0.3,0.5", help="задержка заглушки OpenRouter")
+    parser.add_argument("--rate-429", type=float, default=0.02)
+    parser.add_argument("--rate-503", type=float, default=0.01)
+    parser.add_argument("--telegram-limits", action="store_true", help="не снимать лимиты отправки в Telegram")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как baseline")
+    parser.add_argument("--compare", action="store_true", help="код выхода 1 при ухудшении относительно baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое ухудшение (доля)")
+    parser.add_argument("--repeat", type=int, help="прогонов, по каждой метрике берётся лучший "
+                                                   "(по умолчанию 3 с --compare и --save-baseline, иначе 1)")
+    args = parser.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error(f"неизвестные наборы: {', '.join(sorted(unknown))}")
+    args.suites = args.suites or SUITES
+    if args.repeat is None:
+        args.repeat = 3 if args.compare or args.save_baseline else 1
+
+    # Дочерний прогон --repeat: только результаты в файл
+    if os.getenv("BENCH_OUTPUT"):
+        results = asyncio.run(main(args))
+        with open(os.environ["BENCH_OUTPUT"], "w", encoding="utf-8") as f:
+            json.dump(results, f)
+        sys.exit(0)
+
+    if args.compare and args.save_baseline:
+        parser.error("--compare и --save-baseline несовместимы")
+
+    baseline = load_baseline(args.baseline)
+    if args.compare and not baseline:
+        parser.error(f"нет baseline для сравнения: {args.baseline}")
+    params = suite_params(args)
+
+    results = run_repeated(args.repeat) if args.repeat > 1 else asyncio.run(main(args))
+    print()
+    regressions, compared = report(results, comparable_results(baseline, params), args.threshold)
+    if args.save_baseline:
+        # Наборы, которые сейчас не гоняли, остаются из старого baseline (если он с этой же машины)
+        machine = machine_info()
+        if baseline.get("machine") != machine:
+            baseline = {"params": {}, "results": {}}
+        baseline["machine"] = machine
+        baseline["params"].update(params)
+        baseline["results"] = {
+            **{name: m for name, m in baseline["results"].items() if name.split(".")[0] not in params},
+            **results,
+        }
+        save_baseline(baseline, args.baseline)
+        print(f"\n💾 Baseline сохранён: {args.baseline}")
+    elif regressions:
+        print(f"\n⚠️  Хуже baseline: {regressions} метрик")
+        if args.compare:
+            sys.exit(1)
+    elif args.compare and not compared:
+        print("\n⚠️  Сравнивать не с чем: перезапишите baseline на этой машине с этими параметрами")
+        sys.exit(1)
@@ -0,0 +1,134 @@
+"""Общее для бенчмарков: окружение bot.py, перцентили, отчёт и сравнение с baseline"""
+
+import json
+import os
+import platform
+import statistics
+import tempfile
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def setup_env():
+    """
+    Настройки bot.py для бенчмарков (bot.py читает их при импорте).
+
+    БД всегда временная, чтобы не трогать memory.db; BENCH_DB_DIR задаёт,
+    где её создать (например, на том же диске, что и в проде).
+    """
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:" + "A" * 35)
+    os.environ.setdefault("OPENROUTER_KEY", "benchmark")
+    os.environ.setdefault("METRICS_PORT", "0")
+    db_dir = tempfile.mkdtemp(prefix="ghostai-bench-", dir=os.getenv("BENCH_DB_DIR"))
+    os.environ["DB_PATH"] = os.path.join(db_dir, "memory.db")
+
+
+def db_size(path: str) -> int:
+    """Размер БД вместе с WAL, байт"""
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(samples_ms, elapsed: float) -> dict:
+    """Пропускная способность и перцентили задержки по замерам в миллисекундах"""
+    return {
+        "ops_per_s": len(samples_ms) / elapsed if elapsed else 0.0,
+        "p50_ms": statistics.median(samples_ms),
+        "p95_ms": percentile(samples_ms, 0.95),
+        "p99_ms": percentile(samples_ms, 0.99),
+    }
+
+
+# Для этих метрик больше — лучше; для остальных (задержки, размеры) — наоборот
+HIGHER_IS_BETTER = ("ops_per_s", "speedup")
+# Только для сведения: счётчики нагрузочного теста зависят от случайных ошибок заглушки,
+# а speedup — отношение двух задержек, которые и так сравниваются
+NOT_COMPARED = ("llm_requests", "llm_errors", "telegram_calls", "speedup")
+# Разница во времени одной операции меньше этой (мс) — шум, а не регрессия: у операций
+# в доли миллисекунды (запись в очередь write-behind, тёплый промпт) проценты скачут сильнее
+MIN_MS_DELTA = 0.25
+
+
+def machine_info() -> dict:
+    """На чём сняты результаты: сравнивать можно только с baseline той же машины"""
+    cpu = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    return {
+        "cpu": cpu,
+        "cpus": os.cpu_count(),
+        "python": ".".join(platform.python_version_tuple()[:2]),
+        "system": platform.system(),
+    }
+
+
+def load_baseline(path: str = BASELINE_PATH) -> dict:
+    """
+    Baseline: {"machine": machine_info(), "params": {набор: параметры прогона},
+    "results": {метрика набора: значения}}; пустой словарь, если файла нет.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(baseline: dict, path: str = BASELINE_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def best_of(runs) -> dict:
+    """Лучшее значение каждой метрики по нескольким прогонам"""
+    best = {}
+    for run in runs:
+        for name, metrics in run.items():
+            target = best.setdefault(name, {})
+            for metric, value in metrics.items():
+                pick = max if metric in HIGHER_IS_BETTER else min
+                target[metric] = pick(target.get(metric, value), value)
+    return best
+
+
+def is_regression(metric: str, value: float, old: float, threshold: float) -> bool:
+    if metric in NOT_COMPARED:
+        return False
+    change = (value - old) / old
+    worse = -change if metric in HIGHER_IS_BETTER else change
+    if worse <= threshold:
+        return False
+    if metric == "ops_per_s":
+        # Пропускная способность — через время одной операции
+        return value <= 0 or 1000 / value - 1000 / old >= MIN_MS_DELTA
+    if metric.endswith("_ms"):
+        return value - old >= MIN_MS_DELTA
+    return True
+
+
+def report(results: dict, baseline: dict, threshold: float = 0.25):
+    """
+    Печатает результаты и отличия от baseline (только для метрик, которые в нём есть).
+
+    Returns:
+        (число метрик, ухудшившихся больше чем на threshold, число сравнённых метрик)
+    """
+    regressions = compared = 0
+    for name, metrics in results.items():
+        print(f"\n{name}")
+        base = baseline.get(name, {})
+        for metric, value in metrics.items():
+            line = f"  {metric:14} {value:14.2f}"
+            old = base.get(metric)
+            if old:
+                regressed = is_regression(metric, value, old, threshold)
+                compared += metric not in NOT_COMPARED
+                regressions += regressed
+                mark = "  ⚠️" if regressed else ""
+                line += f"   было {old:.2f} ({(value - old) / old:+.0%}){mark}"
+            print(line)
+    return regressions, compared
@@ -0,0 +1,65 @@
+"""
+Микробенчмарки SQLite: save_message_to_db и load_messages_from_db.
+
+save_message_to_db — одна транзакция с обрезкой до MESSAGES_RETENTION
+на каждое сообщение (путь, которым пишет write-behind при переполнении
+и внешние скрипты); для сравнения — та же запись пачками через
+message_writer. load_messages_from_db читает полную историю чата, как при
+первом обращении к чату после запуска.
+
+    python -m benchmarks db [--iterations 2000]
+"""
+
+import time
+from datetime import datetime, timezone
+
+import bot
+from benchmarks.common import db_size, summarize
+
+CHATS = 50
+
+
+def _message(i: int) -> str:
+    return f"Вася: сообщение номер {i} " + "слово " * 20
+
+
+async def bench_save(iterations: int) -> dict:
+    timings = []
+    started_all = time.perf_counter()
+    for i in range(iterations):
+        started = time.perf_counter()
+        await bot.save_message_to_db(i % CHATS, "user", _message(i), datetime.now(timezone.utc))
+        timings.append((time.perf_counter() - started) * 1000)
+    return summarize(timings, time.perf_counter() - started_all)
+
+
+async def bench_write_behind(iterations: int) -> dict:
+    """Та же запись через очередь message_writer: время постановки в очередь и общий сброс"""
+    timings = []
+    started_all = time.perf_counter()
+    for i in range(iterations):
+        started = time.perf_counter()
+        await bot.message_writer.put(CHATS + i % CHATS, "user", _message(i), datetime.now(timezone.utc))
+        timings.append((time.perf_counter() - started) * 1000)
+    await bot.message_writer.flush()
+    return summarize(timings, time.perf_counter() - started_all)
+
+
+async def bench_load(iterations: int) -> dict:
+    timings = []
+    started_all = time.perf_counter()
+    for i in range(iterations):
+        started = time.perf_counter()
+        await bot.load_messages_from_db(i % CHATS)
+        timings.append((time.perf_counter() - started) * 1000)
+    return summarize(timings, time.perf_counter() - started_all)
+
+
+async def run(iterations: int = 2000) -> dict:
+    results = {
+        "db.save_message": await bench_save(iterations),
+        "db.write_behind": await bench_write_behind(iterations),
+        "db.load_messages": await bench_load(iterations),
+    }
+    results["db.load_messages"]["db_kb"] = db_size(bot.DB_PATH) / 1024
+    return results
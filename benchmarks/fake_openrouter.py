@@ -0,0 +1,181 @@
+"""
+Локальная заглушка OpenRouter и Telegram Bot API для нагрузочных тестов.
+
+OpenRouter (POST /api/v1/chat/completions):
+    - задержка ответа по заданному распределению (--latency);
+    - доля ответов 429 и 503 (--rate-429, --rate-503), 429 — с Retry-After;
+    - при "stream": true — SSE: --chunks кусков текста с паузой --chunk-delay.
+Telegram (POST /bot<token>/<метод>): getMe, sendMessage, editMessageText
+и прочие методы отвечают сразу правдоподобным JSON.
+
+Бота можно натравить на заглушку целиком:
+    python -m benchmarks.fake_openrouter --port 8089 --latency lognormal:1.5,0.6
+    OPENROUTER_URL=http://127.0.0.1:8089/api/v1/chat/completions python bot.py
+(Telegram так подменяется только в benchmarks.load — bot.py ходит в api.telegram.org.)
+
+Распределения задержки (секунды):
+    fixed:0.5            всегда 0.5
+    uniform:0.2,1.5      равномерно от 0.2 до 1.5
+    exp:0.8              экспоненциальное со средним 0.8
+    lognormal:1.5,0.6    логнормальное с медианой 1.5 и sigma 0.6 (длинный хвост, как у LLM)
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 424242, "is_bot": True, "first_name": "GhostAI", "username": "ghostai_bench_bot"}
+
+
+def parse_latency(spec: str, rng: random.Random = random):
+    """Функция без аргументов, возвращающая задержку в секундах по описанию распределения"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: rng.expovariate(1 / values[0])
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: rng.lognormvariate(mu, values[1])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+class FakeOpenRouter:
+    """Заглушка OpenRouter и Telegram Bot API на одном aiohttp сервере"""
+
+    def __init__(self, latency: str = "fixed:0.05", rate_429: float = 0.0, rate_503: float = 0.0,
+                 chunks: int = 8, chunk_delay: float = 0.01, seed: int = None):
+        self.random = random.Random(seed)
+        self.latency = parse_latency(latency, self.random)
+        self.rate_429 = rate_429
+        self.rate_503 = rate_503
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self.errors = 0
+        self.telegram_calls = 0
+        self._message_id = 0
+        self._runner = None
+        self.url = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/v1/chat/completions", self.completions)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        """Запускает сервер (port=0 — свободный порт) и заполняет self.url"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # --- OpenRouter ---
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.latency())
+
+        roll = self.random.random()
+        if roll < self.rate_429:
+            self.errors += 1
+            return web.json_response({"error": {"code": 429, "message": "Rate limit exceeded (fake)"}},
+                                     status=429, headers={"Retry-After": "2"})
+        if roll < self.rate_429 + self.rate_503:
+            self.errors += 1
+            return web.json_response({"error": {"code": 503, "message": "Provider unavailable (fake)"}},
+                                     status=503)
+
+        words = [f"слово{i}" for i in range(self.chunks)]
+        if not body.get("stream"):
+            return web.json_response({
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": {"prompt_tokens": sum(len(m["content"]) for m in body["messages"]) // 4},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await response.prepare(request)
+            await response.write(b": OPENROUTER PROCESSING\n\n")
+            for word in words:
+                chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(self.chunk_delay)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # Бот бросил поток (таймаут первого куска, проигравший hedged-запрос)
+            pass
+        return response
+
+    # --- Telegram Bot API ---
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        self.telegram_calls += 1
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+
+        if method == "getme":
+            return web.json_response({"ok": True, "result": BOT_USER})
+
+        if method in ("sendmessage", "editmessagetext"):
+            chat_id = int(params["chat_id"])
+            if method == "sendmessage":
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(params["message_id"])
+            return web.json_response({"ok": True, "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }})
+
+        return web.json_response({"ok": True, "result": True})
+
+
+async def _serve(args):
+    server = FakeOpenRouter(args.latency, args.rate_429, args.rate_503, args.chunks, args.chunk_delay, args.seed)
+    url = await server.start(args.host, args.port)
+    print(f"🧪 Заглушка OpenRouter: {url}/api/v1/chat/completions")
+    print(f"🧪 Заглушка Telegram:   {url}/bot<token>/<метод>")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка OpenRouter и Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default="lognormal:1.5,0.6", help="распределение задержки ответа")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--rate-503", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--chunks", type=int, default=20, help="кусков текста в ответе")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="сек между кусками в SSE")
+    parser.add_argument("--seed", type=int, default=None)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,128 @@
+"""
+Нагрузочный тест: поток синтетических апдейтов через Dispatcher.
+
+Апдейты (личка и группы, часть групповых — с упоминанием бота) подаются
+в dp.feed_raw_update с ограничением одновременных апдейтов, как их подавал
+бы поллинг или вебхук. OpenRouter и Telegram Bot API заменены локальной
+заглушкой (benchmarks.fake_openrouter), поэтому проходится весь путь:
+middleware и очередь чата, память, сборка промпта, стриминг или fallback,
+отправка через outbox, запись в SQLite, summary.
+
+Задержка апдейта — от постановки в очередь чата до конца обработчика
+(feed_raw_update возвращается сразу после постановки). Лимиты Telegram
+по умолчанию сняты, чтобы мерить сам бот; --telegram-limits их возвращает.
+
+    python -m benchmarks load [--updates 2000 --chats 50 --latency lognormal:0.3,0.5]
+"""
+
+import asyncio
+import contextlib
+import os
+import random
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import bot
+from benchmarks.common import db_size, summarize
+from benchmarks.fake_openrouter import BOT_USER, FakeOpenRouter
+
+
+def make_update(update_id: int, chat_id: int, user_id: int, text: str) -> dict:
+    chat = {"id": chat_id, "type": "private", "first_name": f"User{user_id}"}
+    if chat_id < 0:
+        chat = {"id": chat_id, "type": "supergroup", "title": f"Группа {-chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def generate_updates(count: int, chats: int, group_share: float, mention_share: float, seed: int = 1):
+    """
+    Апдейты для chats чатов: доля group_share из них — группы, где бота
+    упоминают в mention_share сообщений; в личке бот отвечает на всё.
+    """
+    rng = random.Random(seed)
+    groups = int(chats * group_share)
+    chat_ids = [-(1000 + i) for i in range(groups)] + [10_000 + i for i in range(chats - groups)]
+
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = rng.choice(chat_ids)
+        if chat_id < 0:
+            user_id = rng.randint(1, 20)
+            text = f"сообщение {update_id} " + "болтовня " * rng.randint(1, 30)
+            if rng.random() < mention_share:
+                text = f"@{BOT_USER['username']} вопрос {update_id}: что думаешь?"
+        else:
+            user_id = chat_id
+            text = f"вопрос {update_id} " + "слово " * rng.randint(1, 20)
+        updates.append(make_update(update_id, chat_id, user_id, text))
+    return updates
+
+
+async def run(updates: int = 2000, chats: int = 50, group_share: float = 0.6, mention_share: float = 0.2,
+              concurrency: int = 100, latency: str = "lognormal:0.3,0.5", rate_429: float = 0.02,
+              rate_503: float = 0.01, telegram_limits: bool = False) -> dict:
+    server = FakeOpenRouter(latency, rate_429, rate_503, chunks=8, chunk_delay=0.005, seed=1)
+    url = await server.start()
+
+    bot.OPENROUTER_URL = f"{url}/api/v1/chat/completions"
+    tg = Bot(bot.TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    bot.bot = tg
+    bot.bot_identity = None
+    if not telegram_limits:
+        bot.outbox = bot.TelegramOutbox(global_rate=1e6, chat_rate=1e6, group_rate=1e6, burst=1e6,
+                                        max_buckets=bot.TELEGRAM_BUCKETS)
+
+    stream = generate_updates(updates, chats, group_share, mention_share)
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    process = bot.ChatOrderMiddleware._process
+
+    async def timed_process(handler, event, data, chat, queued_at: float):
+        try:
+            await process(handler, event, data, chat, queued_at)
+        finally:
+            latencies.append((time.monotonic() - queued_at) * 1000)
+
+    bot.ChatOrderMiddleware._process = staticmethod(timed_process)
+
+    async def feed(update: dict):
+        async with slots:
+            await bot.dp.feed_raw_update(tg, update)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        bot.summary_queue.start()
+        await bot.get_bot_identity()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(feed(update) for update in stream))
+            await bot.drain_updates(60)
+            elapsed = time.perf_counter() - started
+            await bot.message_writer.flush()
+        finally:
+            await bot.update_scheduler.stop(30)
+            bot.ChatOrderMiddleware._process = process
+            await bot.summary_queue.stop()
+            await tg.session.close()
+            await server.stop()
+
+    result = summarize(latencies, elapsed)
+    result.update({
+        "llm_requests": server.requests,
+        "llm_errors": server.errors,
+        "telegram_calls": server.telegram_calls,
+        "db_kb": db_size(bot.DB_PATH) / 1024,
+    })
+    return {"load.updates": result}
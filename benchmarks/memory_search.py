@@ -0,0 +1,77 @@
+"""
+Микробенчмарк поиска по долгосрочной памяти (memory_index.search).
+
+Архив чата заполняется через save_summary пачками по MAX_MEMORY -
+TAIL_AFTER_SUMMARY сообщений, как при обычной свёртке, до --archived
+записей. Синтетические сообщения — слова из словаря с распределением
+Ципфа, чтобы частые термины были частыми, как в живых чатах. Замеряются
+построение индекса из БД (первый поиск в чате) и поиск по готовому
+индексу вместе с чтением текстов найденного.
+
+    python -m benchmarks search [--iterations 2000] [--archived 100000]
+"""
+
+import contextlib
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+import bot
+from benchmarks.common import summarize
+
+CHAT_ID = -200500
+VOCABULARY = 20000
+ALPHABET = "абвгдежзийклмнопрстуфхцчшщыэюя"
+
+
+def make_words(rng: random.Random):
+    words = ["".join(rng.choices(ALPHABET, k=rng.randint(3, 10))) for _ in range(VOCABULARY)]
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(VOCABULARY)]
+    return lambda count: " ".join(rng.choices(words, weights, k=count))
+
+
+async def fill_archive(archived: int, words):
+    """Заполняет архив чата; возвращает текст нескольких записей для вопросов"""
+    batch = bot.MAX_MEMORY - bot.TAIL_AFTER_SUMMARY
+    now = datetime.now(timezone.utc).timestamp()
+    samples = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for start in range(0, archived, batch + 1):
+            messages = [
+                bot.MemoryRecord("user", f"Юзер{i % 40}: {words(12)}", now - archived + i)
+                for i in range(start, min(start + batch, archived))
+            ]
+            await bot.save_summary(CHAT_ID, f"Обсуждали {words(30)}", messages)
+            samples.append(messages[0].content)
+    return samples
+
+
+async def run(iterations: int = 2000, archived: int = 100_000) -> dict:
+    if not bot.memory_index.enabled:
+        print("⚠️  SEMANTIC_MEMORY=0, набор search пропущен")
+        return {}
+
+    rng = random.Random(0)
+    words = make_words(rng)
+    samples = await fill_archive(archived, words)
+
+    bot.memory_index.forget(CHAT_ID)
+    started = time.perf_counter()
+    await bot.memory_index.search(CHAT_ID, samples[0])
+    build_ms = (time.perf_counter() - started) * 1000
+
+    # Вопрос — кусок реальной записи с добавкой случайных слов
+    queries = [f"{rng.choice(samples)[:60]} {words(4)}?" for _ in range(iterations)]
+    timings = []
+    started_all = time.perf_counter()
+    for query in queries:
+        started = time.perf_counter()
+        await bot.memory_index.search(CHAT_ID, query)
+        timings.append((time.perf_counter() - started) * 1000)
+    result = summarize(timings, time.perf_counter() - started_all)
+
+    index = bot.memory_index._chats[CHAT_ID]
+    result["build_ms"] = build_ms
+    result["index_mb"] = sum(part.nbytes for segment in index.segments for part in segment) / 1024 / 1024
+    return {"search.memory": result}
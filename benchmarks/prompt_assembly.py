@@ -0,0 +1,75 @@
+"""
+Микробенчмарк сборки промпта (build_ai_request).
+
+Чат с полной памятью (MAX_MEMORY + TAIL_AFTER_SUMMARY сообщений за последние
+часы) и SUMMARY_LIMIT сводками. Сравниваются два режима:
+    cold — prompt_cache сбрасывается перед каждым запросом (сборка с нуля,
+           как без кеша: сводки из БД, рендер всех сообщений);
+    warm — части промпта берутся из prompt_cache.
+Для каждого режима — время на запрос и память, выделенная за один запрос
+(пик tracemalloc).
+
+    python -m benchmarks prompt [--iterations 2000]
+"""
+
+import contextlib
+import os
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import bot
+from benchmarks.common import summarize
+
+CHAT_ID = -100500
+
+
+async def fill_chat():
+    """Заполняет память и сводки чата"""
+    now = datetime.now(timezone.utc)
+    count = bot.MAX_MEMORY + bot.TAIL_AFTER_SUMMARY
+    for i in range(count):
+        ts = now - timedelta(minutes=3 * (count - i))
+        if i % 2:
+            await bot.add_to_memory(CHAT_ID, "assistant", f"Бот: ответ номер {i} " + "текст " * 20, ts)
+        else:
+            await bot.add_to_memory(CHAT_ID, "user", f"Вася: вопрос номер {i} " + "слово " * 15, ts)
+    for i in range(bot.SUMMARY_LIMIT):
+        await bot.save_summary(CHAT_ID, f"Сводка {i}: " + "обсуждали разное " * 30)
+
+
+async def measure(iterations: int, cold: bool) -> dict:
+    allocations = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        for _ in range(iterations):
+            if cold:
+                bot.prompt_cache._chats.clear()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            await bot.build_ai_request("как дела?", CHAT_ID, None, bot.DEFAULT_MODEL)
+            allocations.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+
+        # Время — отдельным проходом, без накладных расходов tracemalloc
+        timings = []
+        started_all = time.perf_counter()
+        for _ in range(iterations):
+            if cold:
+                bot.prompt_cache._chats.clear()
+            started = time.perf_counter()
+            await bot.build_ai_request("как дела?", CHAT_ID, None, bot.DEFAULT_MODEL)
+            timings.append((time.perf_counter() - started) * 1000)
+        elapsed = time.perf_counter() - started_all
+
+    result = summarize(timings, elapsed)
+    result["alloc_kb"] = sorted(allocations)[len(allocations) // 2] / 1024
+    return result
+
+
+async def run(iterations: int = 2000) -> dict:
+    await fill_chat()
+    cold = await measure(iterations, cold=True)
+    warm = await measure(iterations, cold=False)
+    warm["speedup"] = cold["p50_ms"] / warm["p50_ms"]
+    return {"prompt.cold": cold, "prompt.warm": warm}
@@ -1,28 +1,78 @@
 import httpx
 import asyncio
+import bisect
+import contextvars
+import hashlib
+import heapq
+import hmac
+import importlib.util
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
 import sqlite3
 import signal
+import sys
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import partial, wraps
 
-from aiogram import Bot, Dispatcher
+from aiogram import BaseMiddleware, Bot, Dispatcher
 from aiogram.filters import Command
-from aiogram.types import Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update
 from aiogram.enums import ChatType
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiohttp import web
 from dotenv import load_dotenv
+import numpy as np
 
 # -------------------------
 #   НАСТРОЙКИ ПАМЯТИ
 # -------------------------
 
-memory_buffer = {}          # chat_id -> list of {role, content}
 MAX_MEMORY = 100            # после этого числа сообщений делаем summary
 TAIL_AFTER_SUMMARY = 10     # сколько последних сообщений оставить после summary
-SUMMARY_LIMIT = 5           # сколько последних summary подгружать при ответе
+SUMMARY_LEVEL_LIMIT = int(os.getenv("SUMMARY_LEVEL_LIMIT", "4"))    # сводок одного уровня до слияния в уровень выше
+SUMMARY_MAX_LEVEL = int(os.getenv("SUMMARY_MAX_LEVEL", "3"))        # верхний уровень: дальше сводки сливаются в нём же
+SUMMARY_LIMIT = SUMMARY_LEVEL_LIMIT * (SUMMARY_MAX_LEVEL + 1)        # сколько summary подгружать при ответе (все уровни)
+MEMORY_MAX_BYTES = int(os.getenv("MEMORY_MAX_BYTES", str(256 * 1024 * 1024)))  # лимит RAM под память всех чатов
+RECORD_OVERHEAD = 80        # байт на сообщение помимо текста (объект со слотами и float)
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))              # одновременных summary в фоне
+SUMMARY_QUEUE_SIZE = int(os.getenv("SUMMARY_QUEUE_SIZE", "1000"))     # макс. чатов в очереди summary
+SUMMARY_RETRIES = 3                                                   # повторов при ошибке OpenRouter
+SUMMARY_RETRY_DELAY = 5.0                                             # сек до первого повтора (дальше x2)
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "20"))      # сек на сводки при остановке
+SESSION_SUMMARY_CONCURRENCY = int(os.getenv("SESSION_SUMMARY_CONCURRENCY", "8"))  # параллельных сводок
+SESSION_SUMMARY_TIMEOUT = 10.0                                        # сек на одну сводку
+MESSAGES_RETENTION = 100    # сколько последних сообщений чата хранить в БД
+SEMANTIC_MEMORY = os.getenv("SEMANTIC_MEMORY", "1") == "1"            # архив и поиск по долгосрочной памяти
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "5"))                # сколько найденных воспоминаний класть в промпт
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.1"))    # минимальное сходство воспоминания с вопросом
+SEMANTIC_CACHE_BYTES = int(os.getenv("SEMANTIC_CACHE_BYTES", str(256 * 1024 * 1024)))  # лимит RAM под индексы чатов (LRU)
 
 # Railway Volume поддержка: если есть /data, используем её
 DB_PATH = os.getenv("DB_PATH", "/data/memory.db" if os.path.exists("/data") else "memory.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))  # потоков-читателей SQLite
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "200"))  # как часто сбрасывать сообщения в БД
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))               # сбросить сразу при стольких строках
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))  # выше — запись прямо в add_to_memory
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))  # чатов в кеше настроек
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "300"))    # сек до перечитывания из БД
+
+# Планировщик апдейтов: по порядку внутри чата, параллельно между чатами
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "64"))          # чатов в обработке одновременно
+SCHEDULER_CHAT_LIMIT = int(os.getenv("SCHEDULER_CHAT_LIMIT", "100"))   # апдейтов в очереди одного чата
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", "5000"))  # апдейтов в очереди всего
+SCHEDULER_DRAIN_TIMEOUT = 15.0                                         # сек на дообработку при остановке
 
 # -------------------------
 #   ДОСТУПНЫЕ МОДЕЛИ
@@ -35,12 +85,81 @@ AVAILABLE_MODELS = {
 }
 
 DEFAULT_MODEL = "deepseek"
+MODEL_KEYS = {full: key for key, full in AVAILABLE_MODELS.items()}  # полное имя -> короткое (для метрик)
+
+# Бюджет промпта (в токенах) для каждой модели: чем меньше промпт, тем быстрее
+# и дешевле ответ, а маленькие бесплатные модели реже обрезают контекст
+MODEL_PROMPT_BUDGETS = {
+    "deepseek": 12000,
+    "mistral": 12000,
+    "nova": 16000
+}
+
+DEFAULT_PROMPT_BUDGET = 8000
+SUMMARY_BUDGET_SHARE = 0.25  # какую долю бюджета история оставляет под сводки
+PROMPT_CACHE_CHATS = int(os.getenv("PROMPT_CACHE_CHATS", "1000"))  # чатов с готовыми частями промпта в RAM
+
+# -------------------------
+#   РЕЖИМЫ FALLBACK
+# -------------------------
+
+FALLBACK_MODES = {
+    "sequential": {
+        "name": "Последовательно",
+        "desc": "Следующая модель только после ошибки предыдущей (меньше запросов)"
+    },
+    "hedged": {
+        "name": "Подстраховка",
+        "desc": "Если модель долго молчит, параллельно спрашиваем следующую"
+    },
+    "race-all": {
+        "name": "Гонка",
+        "desc": "Спрашиваем все модели сразу, берём самый быстрый ответ"
+    }
+}
+
+DEFAULT_FALLBACK_MODE = os.getenv("DEFAULT_FALLBACK_MODE", "hedged")
+HEDGE_DELAY_DEFAULT = float(os.getenv("HEDGE_DELAY_DEFAULT", "8"))  # сек, пока нет статистики задержек
+HEDGE_DELAY_MIN = float(os.getenv("HEDGE_DELAY_MIN", "1"))          # сек, не подстраховываться раньше
+LATENCY_WINDOW = 50                                                 # сколько последних ответов учитывать
+
+# Circuit breaker моделей
+BREAKER_WINDOW = 20                                                      # последних запросов для доли ошибок
+BREAKER_MIN_CALLS = 5                                                    # не судить по меньшему числу
+BREAKER_ERROR_RATE = 0.5                                                 # доля ошибок, после которой отключаем
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))            # сек отключения без Retry-After
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "600"))   # потолок экспоненциального роста
+BREAKER_PROBE_INTERVAL = 10                                              # сек между фоновыми проверками
+BREAKER_PROBE_TIMEOUT = 15                                               # сек на проверочный запрос
+BREAKER_EWMA_ALPHA = 0.3                                                 # вес нового замера в EWMA задержки
+
+# Потоковые ответы
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"                        # показывать ответ по мере генерации
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))          # сек между правками в личке
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv("STREAM_EDIT_INTERVAL_GROUP", "3"))  # в группах лимит правок строже
+STREAM_FIRST_TOKEN_TIMEOUT = float(os.getenv("STREAM_FIRST_TOKEN_TIMEOUT", "10"))  # сек до первого куска, иначе fallback
+STREAM_TOTAL_TIMEOUT = float(os.getenv("STREAM_TOTAL_TIMEOUT", "120"))             # сек на весь потоковый ответ
+TELEGRAM_MESSAGE_LIMIT = 4096                                                   # макс. длина сообщения Telegram
+
+# Склейка упоминаний в группах (включается в чате командой /coalesce)
+COALESCE_DEFAULT_MS = int(os.getenv("COALESCE_DEFAULT_MS", "1500"))  # окно для "/coalesce on"
+COALESCE_MAX_MS = 10000                                              # макс. окно, которое можно задать
+COALESCE_MAX_MENTIONS = 10                                           # упоминаний в одном запросе к AI
+
+# Кеш ответов на повторяющиеся вопросы ("привет", "что ты умеешь")
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"                  # включить кеш ответов
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))       # ответов в RAM
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))       # сек жизни ответа
+RESPONSE_CACHE_CONTEXT = int(os.getenv("RESPONSE_CACHE_CONTEXT", "4"))    # последних сообщений чата в ключе
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "0") == "1"  # дублировать кеш в SQLite
+RESPONSE_CACHE_DB_SIZE = 10000                                            # макс. ответов в SQLite
 
 # -------------------------
 #   СТИЛИ ОБЩЕНИЯ
 # -------------------------
 
 # Структура: {ключ: {"name": "Название", "desc": "Описание", "prompt": "..."}}
+# "cache": False — ответы стиля не берутся из кеша (творческие стили должны каждый раз отвечать по-новому)
 STYLE_PROMPTS = {
     "ассистент": {
         "name": "Ассистент",
@@ -80,6 +199,7 @@ STYLE_PROMPTS = {
     "сказочник": {
         "name": "Сказочник",
         "desc": "Мастер захватывающих историй",
+        "cache": False,
         "prompt": (
             "Ты — Сторителлер, мастер историй. "
             "На запросы создавай захватывающие рассказы: добавляй детали, диалоги, повороты. "
@@ -136,6 +256,7 @@ STYLE_PROMPTS = {
     "безумец": {
         "name": "Безумец +18",
         "desc": "Сумасшедший без тормозов",
+        "cache": False,
         "prompt": (
             "Ты — Анхингед +18, сумасшедший ИИ без тормозов. "
             "Отвечай хаотично, с ругательствами, мемами и абсурдом — будь циничным, провокационным. "
@@ -147,6 +268,7 @@ STYLE_PROMPTS = {
     "флирт": {
         "name": "Флирт +18",
         "desc": "Соблазнительный флирт",
+        "cache": False,
         "prompt": (
             "Ты — Сексуальный +18, соблазнительный ИИ-флирт. "
             "Отвечай игриво, с намеком, описаниями — фокусируйся на желаниях, фантазиях. "
@@ -158,6 +280,7 @@ STYLE_PROMPTS = {
     "романтик": {
         "name": "Романтик +18",
         "desc": "Страстный романтик",
+        "cache": False,
         "prompt": (
             "Ты — Романтический +18, страстный ИИ-романтик. "
             "Создавай сцены любви, давай советы по свиданиям, флирту. "
@@ -181,10 +304,427 @@ STYLE_PROMPTS = {
 DEFAULT_STYLE = "друг"
 
 
+# -------------------------
+#         МЕТРИКИ
+# -------------------------
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))   # порт /metrics в формате Prometheus, 0 — выключено
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")   # по умолчанию только локально
+
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+HANDLER_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счётчик с метками; значения меток передаются позиционно в порядке labels"""
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}  # кортеж значений меток -> число
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    """
+    Гистограмма с метками.
+
+    observe() — поиск корзины bisect'ом и два сложения; накопительные
+    суммы по корзинам, которые ждёт Prometheus, считаются только при выдаче.
+    """
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LLM_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # кортеж значений меток -> [счётчики корзин (+Inf последней), сумма]
+
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+class Sampled:
+    """Значение, которое читается из состояния бота в момент запроса /metrics"""
+
+    def __init__(self, name: str, help_text: str, read, kind: str = "gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield f"{self.name} {self.read()}"
+
+
+llm_requests = Counter("ghostai_llm_requests_total", "Запросы к моделям по исходу", ("model", "outcome"))
+llm_ttfb = Histogram("ghostai_llm_ttfb_seconds", "Время до первого байта (в стриминге — до первого куска текста)",
+                     ("model",), LLM_BUCKETS)
+llm_duration = Histogram("ghostai_llm_duration_seconds", "Полное время запроса к OpenRouter", ("model",), LLM_BUCKETS)
+fallback_requests = Counter("ghostai_fallback_total", "Ответы через ask_ai_with_fallback по числу переходов на другую модель",
+                            ("hops", "result"))
+db_seconds = Histogram("ghostai_db_seconds", "Время операций SQLite (вместе с ожиданием потока)", ("op",), DB_BUCKETS)
+memory_search_seconds = Histogram("ghostai_memory_search_seconds", "Поиск по индексу долгосрочной памяти (без чтения текстов)",
+                                  (), DB_BUCKETS)
+handler_seconds = Histogram("ghostai_handler_seconds", "Время обработчиков по типу чата", ("chat_type",),
+                            HANDLER_BUCKETS)
+
+METRICS = [
+    llm_requests,
+    llm_ttfb,
+    llm_duration,
+    fallback_requests,
+    db_seconds,
+    memory_search_seconds,
+    handler_seconds,
+    Sampled("ghostai_memory_bytes", "Память всех чатов в RAM", lambda: memory_buffer.total_bytes),
+    Sampled("ghostai_memory_chats", "Чатов в RAM", lambda: len(memory_buffer)),
+    Sampled("ghostai_memory_evictions_total", "Чатов выгружено из RAM", lambda: memory_buffer.evictions, "counter"),
+    Sampled("ghostai_summary_queue_depth", "Чатов в очереди на summary", lambda: summary_queue.depth()),
+    Sampled("ghostai_summary_merges_total", "Слияний сводок в уровень выше", lambda: summary_queue.merges, "counter"),
+    Sampled("ghostai_scheduler_pending", "Апдейтов в очереди обработки", lambda: update_scheduler.pending),
+    Sampled("ghostai_scheduler_dropped_total", "Апдейтов отброшено", lambda: update_scheduler.dropped, "counter"),
+    Sampled("ghostai_telegram_sent_total", "Сообщений и правок отправлено", lambda: outbox.sent, "counter"),
+    Sampled("ghostai_telegram_retries_total", "Повторов после RetryAfter", lambda: outbox.retries, "counter"),
+    Sampled("ghostai_response_cache_hits_total", "Ответов из кеша", lambda: response_cache.hits, "counter"),
+]
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server():
+    """Поднимает /metrics на METRICS_HOST:METRICS_PORT; возвращает runner для остановки"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+# -------------------------
+#       ТРАССИРОВКА
+# -------------------------
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))  # доля апдейтов, трейс которых пишется в файл
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "10000"))         # трейсы дольше этого пишутся всегда (0 — нет)
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.path.dirname(DB_PATH) or ".", "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))  # размер файла до ротации
+TRACE_FILE_BACKUPS = 3                                             # сколько старых файлов хранить
+TRACE_MAX_SPANS = 200                                              # спанов в одном трейсе, остальные не пишутся
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    """Один апдейт (или фоновая summary) со всеми его спанами"""
+
+    __slots__ = ("trace_id", "spans", "wall_start", "next_span_id")
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.spans = []
+        self.wall_start = time.time()
+        self.next_span_id = 1  # id растут и после TRACE_MAX_SPANS, когда спаны уже не пишутся
+
+
+class Span:
+    """
+    Этап обработки: имя, время начала и конца, атрибуты.
+
+    Контекстный менеджер: на время with становится текущим спаном (contextvar),
+    поэтому вложенные вызовы, в том числе в задачах, созданных внутри,
+    становятся его детьми. Исключение из with записывается в атрибут error.
+    """
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attrs", "_token")
+
+    def __init__(self, trace: Trace, name: str, parent_id, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = trace.next_span_id
+        trace.next_span_id += 1
+        self.parent_id = parent_id
+        self.start = time.monotonic()
+        self.end = None
+        self.attrs = attrs
+        if len(trace.spans) < TRACE_MAX_SPANS:
+            trace.spans.append(self)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.monotonic()
+        if exc_type is asyncio.CancelledError:
+            self.attrs["cancelled"] = True
+        elif exc_type is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        current_span.reset(self._token)
+        if self.parent_id is None:
+            tracer.finish(self)
+        return False
+
+
+class _NoSpan:
+    """Заглушка вне трейса: этапы фоновых задач без корневого спана не пишутся"""
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """
+    Трассировка апдейтов в JSONL файл с ротацией.
+
+    Спаны собираются для каждого апдейта (это несколько объектов на этап),
+    а решение писать ли трейс принимается в конце: пишется доля
+    TRACE_SAMPLE_RATE и все трейсы дольше TRACE_SLOW_MS. Запись идёт через
+    очередь logging в отдельном потоке, event loop на диск не ждёт.
+    """
+
+    def __init__(self, path: str, sample_rate: float, slow_ms: float, max_bytes: int, backups: int):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.enabled = sample_rate > 0 or slow_ms > 0
+        self.exported = 0
+        self._logger = None
+        self._listener = None
+
+    def span(self, name: str, root: bool = False, **attrs):
+        """
+        Спан внутри текущего трейса. Без текущего трейса root=True начинает
+        новый, а обычный спан ничего не делает.
+        """
+        if not self.enabled:
+            return NO_SPAN
+        parent = current_span.get()
+        if parent is None:
+            if not root:
+                return NO_SPAN
+            return Span(Trace(), name, None, attrs)
+        return Span(parent.trace, name, parent.span_id, attrs)
+
+    def annotate(self, **attrs):
+        """Добавляет атрибуты текущему спану"""
+        span = current_span.get()
+        if span is not None:
+            span.set(**attrs)
+
+    def record(self, name: str, start: float, end: float, **attrs):
+        """Добавляет уже завершившийся этап (например, ожидание в очереди) к текущему спану"""
+        parent = current_span.get()
+        if parent is not None:
+            span = Span(parent.trace, name, parent.span_id, attrs)
+            span.start = start
+            span.end = end
+
+    def finish(self, root: Span):
+        duration_ms = (root.end - root.start) * 1000
+        slow = self.slow_ms > 0 and duration_ms >= self.slow_ms
+        if not slow and random.random() >= self.sample_rate:
+            return
+        if slow:
+            print(f"🐌 {root.name} {duration_ms / 1000:.1f} с, trace {root.trace.trace_id}")
+        self._export(root, duration_ms, slow)
+
+    def _export(self, root: Span, duration_ms: float, slow: bool):
+        if self._logger is None:
+            self._start_writer()
+        trace = root.trace
+        record = {
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "time": datetime.fromtimestamp(trace.wall_start, timezone.utc).isoformat(),
+            "duration_ms": round(duration_ms, 1),
+            "slow": slow,
+            "spans": [
+                {
+                    "id": span.span_id,
+                    "parent": span.parent_id,
+                    "name": span.name,
+                    "start_ms": round((span.start - root.start) * 1000, 1),
+                    "duration_ms": round((span.end - span.start) * 1000, 1) if span.end is not None else None,
+                    **span.attrs,
+                }
+                for span in trace.spans
+            ],
+        }
+        self._logger.info(json.dumps(record, ensure_ascii=False, default=str))
+        self.exported += 1
+
+    def _start_writer(self):
+        handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=self.max_bytes, backupCount=self.backups, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        records = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(records, handler)
+        self._listener.start()
+
+        self._logger = logging.getLogger("ghostai.traces")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._logger.addHandler(logging.handlers.QueueHandler(records))
+
+    def close(self):
+        """Дописывает очередь трейсов в файл"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUPS)
+
+
+def traced(name: str, root: bool = False):
+    """Декоратор: корутина целиком — спан name (см. Tracer.span)"""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name, root=root):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 # -------------------------
 #   РАБОТА С БАЗОЙ
 # -------------------------
 
+class Storage:
+    """
+    Доступ к SQLite вне event loop.
+
+    Чтения выполняются в небольшом пуле потоков, записи — в единственном
+    потоке-писателе (SQLite всё равно допускает только одного писателя).
+    У каждого потока своё постоянное соединение в режиме WAL, поэтому
+    подготовленные выражения берутся из кеша sqlite3, а медленный fsync
+    блокирует только поток-писатель, а не обработчики сообщений.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READ_POOL_SIZE):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._reader = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего потока (создаёт при первом обращении)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # check_same_thread=False нужен только для close() из главного потока,
+            # запросы к соединению всегда идут из его собственного потока
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn, args):
+        return fn(self._connection(), *args)
+
+    def _call_in_transaction(self, fn, args):
+        conn = self._connection()
+        with conn:
+            return fn(conn, *args)
+
+    async def read(self, fn, *args):
+        """Выполняет fn(conn, *args) в пуле читателей"""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            return await loop.run_in_executor(self._reader, self._call, fn, args)
+        finally:
+            db_seconds.observe(time.monotonic() - started, fn.__name__.lstrip("_"))
+
+    async def write(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке-писателе внутри одной транзакции"""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            return await loop.run_in_executor(self._writer, self._call_in_transaction, fn, args)
+        finally:
+            db_seconds.observe(time.monotonic() - started, fn.__name__.lstrip("_"))
+
+    def close(self):
+        """Дожидается всех запросов и закрывает соединения"""
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
 def init_db():
     # Создаём директорию для БД, если её нет
     db_dir = os.path.dirname(DB_PATH)
@@ -194,6 +734,9 @@ def init_db():
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
+    # WAL сохраняется в файле БД: читатели не блокируют писателя и наоборот
+    cur.execute("PRAGMA journal_mode=WAL")
+
     # Таблица для хранения сводок переписок
     cur.execute("""
         CREATE TABLE IF NOT EXISTS chat_summaries (
@@ -226,551 +769,3106 @@ def init_db():
         )
     """)
 
-    # Индекс для быстрой выборки последних сообщений
+    conn.commit()
+
+    # Доводим схему существующей БД до актуальной версии
+    migrate_db(conn)
+    conn.close()
+
+
+def _migration_messages_by_id(cur: sqlite3.Cursor):
+    """
+    v1: chat_messages выбираются и обрезаются по id, а не по строке timestamp.
+
+    Индекс (chat_id, timestamp) заменяется на (chat_id, id), а старые БД,
+    где из-за сортировки по timestamp могло остаться больше MESSAGES_RETENTION
+    сообщений на чат, один раз обрезаются до лимита.
+    """
+    cur.execute("DROP INDEX IF EXISTS idx_chat_messages_lookup")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id
+        ON chat_messages(chat_id, id)
+    """)
+    cur.execute("""
+        DELETE FROM chat_messages WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id DESC) AS rn
+                FROM chat_messages
+            )
+            WHERE rn > ?
+        )
+    """, (MESSAGES_RETENTION,))
+
+
+def _migration_fallback_mode(cur: sqlite3.Cursor):
+    """v2: режим fallback между моделями в настройках чата"""
+    cur.execute("ALTER TABLE chat_settings ADD COLUMN fallback_mode TEXT")
+
+
+def _migration_pending_summaries(cur: sqlite3.Cursor):
+    """v3: чаты, которые не успели свернуть при остановке"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pending_summaries (
+            chat_id INTEGER PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _migration_coalesce_window(cur: sqlite3.Cursor):
+    """v4: окно склейки упоминаний в группе (мс, 0 — выключено)"""
+    cur.execute("ALTER TABLE chat_settings ADD COLUMN coalesce_ms INTEGER DEFAULT 0")
+
+
+def _migration_response_cache(cur: sqlite3.Cursor):
+    """v5: персистентный уровень кеша ответов"""
     cur.execute("""
-        CREATE INDEX IF NOT EXISTS idx_chat_messages_lookup
-        ON chat_messages(chat_id, timestamp DESC)
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            latency REAL,
+            expires_at REAL
+        )
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)")
 
-    conn.commit()
-    conn.close()
 
+def _migration_summary_levels(cur: sqlite3.Cursor):
+    """v6: уровни сводок для иерархического слияния и индекс по чату"""
+    cur.execute("ALTER TABLE chat_summaries ADD COLUMN level INTEGER DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_summaries_chat_level ON chat_summaries(chat_id, level, id)")
 
-def save_summary(chat_id: int, summary: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
+
+def _migration_memory_archive(cur: sqlite3.Cursor):
+    """v7: архив долгосрочной памяти для семантического поиска (с уже сохранёнными сводками)"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS memory_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            kind TEXT,
+            content TEXT,
+            terms BLOB,
+            ts REAL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_memory_archive_chat ON memory_archive(chat_id, id)")
+    rows = cur.execute(
+        "SELECT chat_id, summary, CAST(strftime('%s', created_at) AS REAL) FROM chat_summaries ORDER BY id"
+    ).fetchall()
+    cur.executemany(
+        "INSERT INTO memory_archive (chat_id, kind, content, terms, ts) VALUES (?, 'summary', ?, ?, ?)",
+        ((chat_id, summary, memory_terms(summary), ts) for chat_id, summary, ts in rows)
+    )
+
+
+# Миграции схемы по порядку; номер версии хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migration_messages_by_id,
+    _migration_fallback_mode,
+    _migration_pending_summaries,
+    _migration_coalesce_window,
+    _migration_response_cache,
+    _migration_summary_levels,
+    _migration_memory_archive,
+]
+
+
+def migrate_db(conn: sqlite3.Connection):
+    """Применяет миграции, которых ещё нет в БД"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"🗄️  Миграция БД до версии {number}: {migration.__name__}")
+        cur = conn.cursor()
+        migration(cur)
+        cur.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+
+
+storage = Storage(DB_PATH)
+
+
+# Синхронные реализации: выполняются только в потоках Storage
+
+def _save_summary(conn: sqlite3.Connection, chat_id: int, summary: str, messages=()):
+    """
+    Сохраняет сводку. При SEMANTIC_MEMORY кладёт в архив долгосрочной
+    памяти свёрнутые в неё сообщения и саму сводку.
+
+    Returns:
+        [(id, термины)] новых записей архива
+    """
+    conn.execute(
         "INSERT INTO chat_summaries (chat_id, summary) VALUES (?, ?)",
         (chat_id, summary)
     )
-    conn.commit()
-    conn.close()
+    if not SEMANTIC_MEMORY:
+        return []
+
+    archived = []
+    entries = [("message", m.content, m.ts) for m in messages]
+    entries.append(("summary", summary, time.time()))
+    for kind, content, ts in entries:
+        terms = memory_terms(content)
+        cur = conn.execute(
+            "INSERT INTO memory_archive (chat_id, kind, content, terms, ts) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, kind, content, terms, ts)
+        )
+        archived.append((cur.lastrowid, terms))
+    return archived
 
 
-def load_recent_summaries(chat_id: int, limit: int = SUMMARY_LIMIT):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
+def _load_recent_summaries(conn: sqlite3.Connection, chat_id: int, limit: int):
+    """
+    Сводки всех уровней: чем выше уровень, тем более давнюю историю он
+    покрывает, а внутри уровня порядок задаёт id. Если слияние ещё не
+    догнало (старая БД), LIMIT отрезает самое давнее, а не свежее.
+
+    Returns:
+        [(уровень, сводка)] в хронологическом порядке (старые → новые)
+    """
+    rows = conn.execute(
         """
-        SELECT summary FROM chat_summaries
+        SELECT level, summary FROM chat_summaries
         WHERE chat_id = ?
-        ORDER BY id DESC
+        ORDER BY level ASC, id DESC
         LIMIT ?
         """,
         (chat_id, limit)
-    )
-    rows = cur.fetchall()
-    conn.close()
-    # возвращаем в хронологическом порядке (старые → новые)
-    return [row[0] for row in rows[::-1]]
+    ).fetchall()
+    return rows[::-1]
 
 
-def get_chat_settings(chat_id: int):
-    """Получает настройки чата из БД"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT model, style FROM chat_settings WHERE chat_id = ?",
+def _count_summaries_by_level(conn: sqlite3.Connection, chat_id: int) -> dict:
+    return dict(conn.execute(
+        "SELECT level, COUNT(*) FROM chat_summaries WHERE chat_id = ? GROUP BY level",
         (chat_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
-
-    if row:
-        return {"model": row[0], "style": row[1]}
-    else:
-        # Если настроек нет, возвращаем дефолтные
-        return {"model": DEFAULT_MODEL, "style": DEFAULT_STYLE}
+    ).fetchall())
 
 
-def update_chat_setting(chat_id: int, setting_name: str, value: str):
-    """Обновляет одну настройку чата"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+def _load_oldest_summaries(conn: sqlite3.Connection, chat_id: int, level: int, limit: int):
+    return conn.execute(
+        """
+        SELECT id, summary FROM chat_summaries
+        WHERE chat_id = ? AND level = ?
+        ORDER BY id
+        LIMIT ?
+        """,
+        (chat_id, level, limit)
+    ).fetchall()
 
-    # Проверяем, есть ли уже запись для этого чата
-    cur.execute("SELECT chat_id FROM chat_settings WHERE chat_id = ?", (chat_id,))
-    exists = cur.fetchone()
 
-    if exists:
-        # Обновляем существующую запись
-        cur.execute(
-            f"UPDATE chat_settings SET {setting_name} = ?, updated_at = CURRENT_TIMESTAMP WHERE chat_id = ?",
-            (value, chat_id)
-        )
-    else:
-        # Создаём новую запись
-        cur.execute(
-            f"INSERT INTO chat_settings (chat_id, {setting_name}) VALUES (?, ?)",
-            (chat_id, value)
-        )
+def _replace_summaries(conn: sqlite3.Connection, chat_id: int, ids, summary: str, level: int) -> bool:
+    """
+    Заменяет слитые сводки одной сводкой уровнем выше (одной транзакцией).
 
-    conn.commit()
-    conn.close()
+    Новая сводка получает наименьший id из слитых: порядок внутри уровня
+    задаёт id, и на SUMMARY_MAX_LEVEL слитая сводка должна остаться самой
+    давней, а не встать после более свежих. Если часть сводок уже удалена
+    (чат очистили, пока шло слияние), ничего не сохраняет, чтобы не вернуть
+    стёртую память.
+    """
+    deleted = conn.execute(
+        f"DELETE FROM chat_summaries WHERE chat_id = ? AND id IN ({','.join('?' * len(ids))})",
+        (chat_id, *ids)
+    ).rowcount
+    if deleted != len(ids):
+        conn.rollback()
+        return False
+    conn.execute(
+        "INSERT INTO chat_summaries (id, chat_id, summary, level) VALUES (?, ?, ?, ?)",
+        (min(ids), chat_id, summary, level)
+    )
+    return True
 
 
-def count_summaries(chat_id: int) -> int:
-    """Подсчитывает количество summaries для чата"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT COUNT(*) FROM chat_summaries WHERE chat_id = ?",
+def _get_chat_settings(conn: sqlite3.Connection, chat_id: int):
+    row = conn.execute(
+        "SELECT model, style, fallback_mode, coalesce_ms FROM chat_settings WHERE chat_id = ?",
         (chat_id,)
+    ).fetchone()
+
+    if row:
+        return {"model": row[0], "style": row[1], "fallback_mode": row[2] or DEFAULT_FALLBACK_MODE,
+                "coalesce_ms": row[3] or 0}
+    else:
+        # Если настроек нет, возвращаем дефолтные
+        return {"model": DEFAULT_MODEL, "style": DEFAULT_STYLE, "fallback_mode": DEFAULT_FALLBACK_MODE,
+                "coalesce_ms": 0}
+
+
+def _update_chat_setting(conn: sqlite3.Connection, chat_id: int, setting_name: str, value: str):
+    # Одним запросом: создаём запись или обновляем существующую
+    conn.execute(
+        f"""
+        INSERT INTO chat_settings (chat_id, {setting_name}) VALUES (?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            {setting_name} = excluded.{setting_name},
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        (chat_id, value)
     )
-    count = cur.fetchone()[0]
-    conn.close()
-    return count
 
 
-def count_messages(chat_id: int) -> int:
-    """Подсчитывает количество сообщений в БД для чата"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
+def _count_messages(conn: sqlite3.Connection, chat_id: int) -> int:
+    return conn.execute(
         "SELECT COUNT(*) FROM chat_messages WHERE chat_id = ?",
         (chat_id,)
-    )
-    count = cur.fetchone()[0]
-    conn.close()
-    return count
-
+    ).fetchone()[0]
 
-def save_message_to_db(chat_id: int, role: str, content: str, timestamp):
-    """Сохраняет сообщение в БД и удаляет старые (хранит последние 100)"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
 
+def _save_messages_batch(conn: sqlite3.Connection, rows):
+    """Сохраняет пачку сообщений (chat_id, role, content, timestamp) одной транзакцией"""
     # Конвертируем timestamp в ISO формат для SQLite
-    if isinstance(timestamp, datetime):
-        timestamp_str = timestamp.isoformat()
-    else:
-        timestamp_str = timestamp
-
-    # Сохраняем сообщение
-    cur.execute(
+    conn.executemany(
         "INSERT INTO chat_messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
-        (chat_id, role, content, timestamp_str)
-    )
-
-    # Удаляем старые сообщения, оставляя последние 100
-    cur.execute("""
-        DELETE FROM chat_messages
-        WHERE chat_id = ? AND id NOT IN (
-            SELECT id FROM chat_messages
-            WHERE chat_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 100
+        (
+            (chat_id, role, content, timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp)
+            for chat_id, role, content, timestamp in rows
         )
-    """, (chat_id, chat_id))
+    )
 
-    conn.commit()
-    conn.close()
+    # Удаляем старые сообщения, оставляя последние MESSAGES_RETENTION (один раз на чат в пачке).
+    # Водяной знак — id сообщения, стоящего сразу за лимитом: поиск по индексу
+    # (chat_id, id) и удаление только вытесненных строк, без сортировки всей истории чата
+    for chat_id in {row[0] for row in rows}:
+        conn.execute("""
+            DELETE FROM chat_messages
+            WHERE chat_id = ? AND id <= (
+                SELECT id FROM chat_messages
+                WHERE chat_id = ?
+                ORDER BY id DESC
+                LIMIT 1 OFFSET ?
+            )
+        """, (chat_id, chat_id, MESSAGES_RETENTION))
 
 
-def load_messages_from_db(chat_id: int, limit: int = 100):
-    """Загружает последние N сообщений из БД"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
+def _load_messages_from_db(conn: sqlite3.Connection, chat_id: int, limit: int):
+    rows = conn.execute(
         """
         SELECT role, content, timestamp FROM chat_messages
         WHERE chat_id = ?
-        ORDER BY timestamp DESC
+        ORDER BY id DESC
         LIMIT ?
         """,
         (chat_id, limit)
-    )
-    rows = cur.fetchall()
-    conn.close()
+    ).fetchall()
 
     # Возвращаем в хронологическом порядке (старые → новые)
     messages = []
-    for row in reversed(rows):
-        messages.append({
-            "role": row[0],
-            "content": row[1],
-            "timestamp": datetime.fromisoformat(row[2]) if isinstance(row[2], str) else row[2]
-        })
+    for role, content, timestamp in reversed(rows):
+        ts = datetime.fromisoformat(timestamp)
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        messages.append(MemoryRecord(role, content, ts.timestamp()))
     return messages
 
 
-def clear_chat_memory(chat_id: int):
-    """Очищает память чата (RAM, БД сообщений и summaries)"""
-    # Очищаем краткосрочную память из RAM
-    if chat_id in memory_buffer:
-        memory_buffer[chat_id] = []
+def _clear_chat_memory(conn: sqlite3.Connection, chat_id: int):
+    conn.execute("DELETE FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+    conn.execute("DELETE FROM memory_archive WHERE chat_id = ?", (chat_id,))
+    conn.execute("DELETE FROM chat_messages WHERE chat_id = ?", (chat_id,))
+    conn.execute("DELETE FROM pending_summaries WHERE chat_id = ?", (chat_id,))
 
-    # Очищаем БД
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM chat_summaries WHERE chat_id = ?", (chat_id,))
-    cur.execute("DELETE FROM chat_messages WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
 
+def _mark_pending_summaries(conn: sqlite3.Connection, chat_ids):
+    conn.executemany(
+        "INSERT OR IGNORE INTO pending_summaries (chat_id) VALUES (?)",
+        ((chat_id,) for chat_id in chat_ids)
+    )
 
-# -------------------------
-#   ГЛОБАЛЬНАЯ ПАМЯТЬ В RAM
-# -------------------------
 
-def add_to_memory(chat_id, role, text, timestamp=None):
-    """Добавляет сообщение в краткосрочную память чата с временной меткой"""
-    if chat_id not in memory_buffer:
-        memory_buffer[chat_id] = []
+def _load_pending_summaries(conn: sqlite3.Connection):
+    return [row[0] for row in conn.execute("SELECT chat_id FROM pending_summaries ORDER BY created_at")]
 
-    if timestamp is None:
-        timestamp = datetime.now(timezone.utc)
 
-    memory_buffer[chat_id].append({
-        "role": role,
-        "content": text,
-        "timestamp": timestamp
-    })
+def _unmark_pending_summary(conn: sqlite3.Connection, chat_id: int):
+    conn.execute("DELETE FROM pending_summaries WHERE chat_id = ?", (chat_id,))
 
-    # Сохраняем сообщение в БД для постоянного хранения
-    save_message_to_db(chat_id, role, text, timestamp)
 
-    # просто ограничиваем длину буфера здесь,
-    # summary делаем отдельно в хэндлере
-    if len(memory_buffer[chat_id]) > MAX_MEMORY + TAIL_AFTER_SUMMARY:
-        memory_buffer[chat_id] = memory_buffer[chat_id][-MAX_MEMORY:]
+def _save_session_summary(conn: sqlite3.Connection, chat_id: int, summary: str):
+    """Сохраняет сводку сессии (если есть) и снимает отметку «ждёт summary» одной транзакцией"""
+    archived = _save_summary(conn, chat_id, summary) if summary else []
+    _unmark_pending_summary(conn, chat_id)
+    return archived
+
+
+def _load_memory_archive(conn: sqlite3.Connection, chat_id: int):
+    """Строит индекс архива чата (в потоке читателя, чтобы не держать event loop)"""
+    rows = conn.execute(
+        "SELECT id, terms FROM memory_archive WHERE chat_id = ? ORDER BY id",
+        (chat_id,)
+    ).fetchall()
+    return ChatIndex.build(rows)
+
+
+def _load_archived(conn: sqlite3.Connection, ids):
+    rows = conn.execute(
+        f"SELECT id, kind, content, ts FROM memory_archive WHERE id IN ({','.join('?' * len(ids))})",
+        ids
+    ).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+
+def _load_cached_response(conn: sqlite3.Connection, key: str):
+    return conn.execute(
+        "SELECT response, latency, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+        (key, time.time())
+    ).fetchone()
+
+
+def _save_cached_response(conn: sqlite3.Connection, key: str, response: str, latency: float, expires_at: float):
+    conn.execute(
+        "INSERT OR REPLACE INTO response_cache (key, response, latency, expires_at) VALUES (?, ?, ?, ?)",
+        (key, response, latency, expires_at)
+    )
+
+
+def _purge_response_cache(conn: sqlite3.Connection, max_rows: int):
+    """Удаляет истёкшие ответы и самые старые сверх max_rows"""
+    conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+    conn.execute("""
+        DELETE FROM response_cache WHERE expires_at < (
+            SELECT expires_at FROM response_cache ORDER BY expires_at DESC LIMIT 1 OFFSET ?
+        )
+    """, (max_rows - 1,))
+
+
+class SettingsCache:
+    """
+    LRU кеш настроек чатов с TTL.
+
+    Настройки читаются на каждом ответе (и на каждой попытке fallback),
+    а меняются редко — через /model, /style, /fallback и кнопки, которые
+    идут через update_chat_setting и обновляют кеш сразу (write-through).
+    TTL нужен только на случай правки БД в обход бота.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # chat_id -> (настройки, время загрузки)
+        self.writes = 0                # счётчик записей, чтобы не закешировать устаревшее чтение
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int):
+        entry = self._entries.get(chat_id)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(chat_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, chat_id: int, settings: dict):
+        self._entries[chat_id] = (settings, time.monotonic())
+        self._entries.move_to_end(chat_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update(self, chat_id: int, setting_name: str, value: str):
+        """Write-through: меняет закешированную настройку (словарь заменяется, а не правится)"""
+        self.writes += 1
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            self.put(chat_id, {**entry[0], setting_name: value})
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+settings_cache = SettingsCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL)
+
+
+# Асинхронный API для обработчиков
+
+async def save_summary(chat_id: int, summary: str, messages=()):
+    """Сохраняет сводку (и в архив — её и свёрнутые сообщения), обновляя индекс поиска"""
+    archived = await storage.write(_save_summary, chat_id, summary, messages)
+    prompt_cache.invalidate_summaries(chat_id)
+    memory_index.add(chat_id, archived)
+
+
+async def load_recent_summaries(chat_id: int, limit: int = SUMMARY_LIMIT):
+    return await storage.read(_load_recent_summaries, chat_id, limit)
+
+
+async def get_chat_settings(chat_id: int):
+    """Получает настройки чата (из кеша, при промахе — из БД)"""
+    settings = settings_cache.get(chat_id)
+    if settings is not None:
+        return settings
+
+    writes = settings_cache.writes
+    settings = await storage.read(_get_chat_settings, chat_id)
+    # Если настройки меняли, пока шло чтение, прочитанное могло устареть
+    if settings_cache.writes == writes:
+        settings_cache.put(chat_id, settings)
+    return settings
+
+
+async def update_chat_setting(chat_id: int, setting_name: str, value: str):
+    """Обновляет одну настройку чата (в БД и в кеше)"""
+    await storage.write(_update_chat_setting, chat_id, setting_name, value)
+    settings_cache.update(chat_id, setting_name, value)
+
+
+async def count_summaries(chat_id: int) -> dict:
+    """Подсчитывает количество summaries для чата по уровням: {уровень: число}"""
+    return await storage.read(_count_summaries_by_level, chat_id)
+
+
+async def count_messages(chat_id: int) -> int:
+    """Подсчитывает количество сообщений в БД для чата"""
+    return await storage.read(_count_messages, chat_id)
+
+
+async def save_message_to_db(chat_id: int, role: str, content: str, timestamp):
+    """Сохраняет сообщение в БД и удаляет старые (хранит последние MESSAGES_RETENTION)"""
+    await storage.write(_save_messages_batch, [(chat_id, role, content, timestamp)])
+
+
+async def load_messages_from_db(chat_id: int, limit: int = MESSAGES_RETENTION):
+    """Загружает последние N сообщений из БД"""
+    return await storage.read(_load_messages_from_db, chat_id, limit)
+
+
+async def clear_chat_memory(chat_id: int):
+    """Очищает память чата (RAM, БД сообщений и summaries)"""
+    # Очищаем краткосрочную память из RAM (чат остаётся загруженным, но пустым)
+    memory_buffer.load(chat_id, ())
+
+    # Очищаем БД (и ещё не записанные сообщения этого чата)
+    message_writer.discard(chat_id)
+    await storage.write(_clear_chat_memory, chat_id)
+    prompt_cache.invalidate_summaries(chat_id)
+    memory_index.forget(chat_id)
+
+
+class MessageWriteBehind:
+    """
+    Отложенная пакетная запись сообщений в chat_messages.
+
+    add_to_memory только кладёт строку в очередь, а фоновая задача раз в
+    interval секунд (или сразу при накоплении batch_size строк) пишет всё
+    накопленное одной транзакцией — один fsync на пачку вместо одного
+    на сообщение. При max_pending строк в очереди put() ждёт записи сам,
+    так что очередь не растёт без ограничений, даже если задача не запущена.
+    Записи идут по одной под замком: flush() возвращается, только когда
+    в БД лежит и то, что уже писалось в момент вызова.
+    """
+
+    def __init__(self, interval: float, batch_size: int, max_pending: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = []
+        self._lock = asyncio.Lock()  # пачка в работе у потока-писателя
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Запускает фоновую запись (вызывается из main())"""
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, chat_id: int, role: str, content: str, timestamp):
+        self._pending.append((chat_id, role, content, timestamp))
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+        elif len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def discard(self, chat_id: int):
+        """Выбрасывает ещё не записанные сообщения чата (для /clear)"""
+        self._pending = [row for row in self._pending if row[0] != chat_id]
+
+    async def load(self, chat_id: int, limit: int):
+        """
+        Последние limit сообщений чата: из БД и ещё не записанные из очереди.
+
+        Ничего не записывает: под замком только дожидается пачки, которая уже
+        пишется, и не даёт начаться новой, пока идёт чтение, — так строка не
+        потеряется между очередью и БД и не попадёт в выборку дважды.
+        """
+        async with self._lock:
+            records = await load_messages_from_db(chat_id, limit)
+            queued = [
+                MemoryRecord(role, content, timestamp.timestamp())
+                for row_chat_id, role, content, timestamp in self._pending
+                if row_chat_id == chat_id
+            ]
+        return (records + queued)[-limit:]
+
+    async def flush(self):
+        """Записывает всё накопленное одной транзакцией (дождавшись пачки, которая уже пишется)"""
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            try:
+                await storage.write(_save_messages_batch, batch)
+            except Exception:
+                # Возвращаем пачку в начало очереди, чтобы не потерять сообщения
+                self._pending[:0] = batch
+                raise
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Ошибка пакетной записи сообщений: {e}")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает остаток очереди"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+message_writer = MessageWriteBehind(
+    interval=WRITE_BEHIND_INTERVAL_MS / 1000,
+    batch_size=WRITE_BEHIND_BATCH,
+    max_pending=WRITE_BEHIND_MAX_PENDING,
+)
+
+
+# -------------------------
+#   ГЛОБАЛЬНАЯ ПАМЯТЬ В RAM
+# -------------------------
+
+class MemoryRecord:
+    """Сообщение в краткосрочной памяти; ts — время отправки в секундах epoch (UTC)"""
+
+    __slots__ = ("role", "content", "ts")
+
+    def __init__(self, role: str, content: str, ts: float):
+        self.role = role
+        self.content = content
+        self.ts = ts
+
+    def nbytes(self) -> int:
+        """Приблизительный размер в памяти: объект со слотами, float и текст"""
+        return RECORD_OVERHEAD + sys.getsizeof(self.content)
+
+
+class ChatMemory:
+    """
+    Краткосрочная память одного чата: кольцевой буфер фиксированной ёмкости.
+
+    Новое сообщение при заполненном буфере вытесняет самое старое без
+    копирования списка. Ведёт подсчёт занимаемой памяти. Сам буфер выделяется
+    при первом сообщении, так что память пустого чата почти ничего не стоит.
+    """
+
+    __slots__ = ("_items", "_start", "_size", "nbytes")
+
+    capacity = MAX_MEMORY + TAIL_AFTER_SUMMARY
+
+    def __init__(self, records=()):
+        self._items = None
+        self._start = 0
+        self._size = 0
+        self.nbytes = 0
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        items, start, capacity = self._items, self._start, self.capacity
+        for i in range(self._size):
+            yield items[(start + i) % capacity]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("ChatMemory index out of range")
+        return self._items[(self._start + index) % self.capacity]
+
+    def append(self, record: MemoryRecord) -> int:
+        """Добавляет сообщение; возвращает изменение занимаемой памяти в байтах"""
+        delta = record.nbytes()
+        if self._items is None:
+            self._items = [None] * self.capacity
+            delta += sys.getsizeof(self._items)
+        end = (self._start + self._size) % self.capacity
+        if self._size == self.capacity:
+            # Буфер полон — перезаписываем самое старое сообщение
+            delta -= self._items[end].nbytes()
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._size += 1
+        self._items[end] = record
+        self.nbytes += delta
+        return delta
+
+    def drop_through(self, record: MemoryRecord) -> int:
+        """
+        Убирает всё до record включительно (ищется по ссылке на объект).
+
+        Returns:
+            Освобождённые байты, или -1, если record в буфере нет
+        """
+        for i, current in enumerate(self):
+            if current is record:
+                break
+        else:
+            return -1
+
+        freed = 0
+        for _ in range(i + 1):
+            freed += self._items[self._start].nbytes()
+            self._items[self._start] = None
+            self._start = (self._start + 1) % self.capacity
+            self._size -= 1
+        self.nbytes -= freed
+        return freed
+
+
+class MemoryStore:
+    """
+    Краткосрочная память всех чатов с общим лимитом.
+
+    Когда суммарный размер превышает max_bytes, из RAM вытесняются дольше
+    всех не использовавшиеся чаты; их история остаётся в БД и лениво
+    подгружается обратно через get_memory.
+
+    Чат в _chats считается загруженным, даже если его память пуста (новый
+    чат, /clear): пустота больше не означает «надо сходить в БД».
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()  # chat_id -> ChatMemory, от давно использованных к недавним
+        self._loading = {}           # chat_id -> задача загрузки из БД (одна на чат)
+        self.total_bytes = 0
+        self.evictions = 0
+        self.hits = 0                # get_memory без обращения к БД
+        self.db_loads = 0            # загрузок истории из БД
+
+    def __len__(self):
+        return len(self._chats)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    def get(self, chat_id: int):
+        """Память чата или None, если чат не загружен; отмечает чат как недавно использованный"""
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            self._chats.move_to_end(chat_id)
+        return chat
+
+    def load(self, chat_id: int, records) -> ChatMemory:
+        """Заменяет память чата загруженными сообщениями"""
+        self.drop(chat_id)
+        chat = ChatMemory(records)
+        self._chats[chat_id] = chat
+        self.total_bytes += chat.nbytes
+        self._evict(keep=chat_id)
+        return chat
+
+    def append(self, chat_id: int, record: MemoryRecord):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self.load(chat_id, ())
+        self._chats.move_to_end(chat_id)
+        self.total_bytes += chat.append(record)
+        self._evict(keep=chat_id)
+
+    def drop_through(self, chat_id: int, record: MemoryRecord) -> bool:
+        """Убирает из памяти чата всё до record включительно (после summary)"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return False
+        freed = chat.drop_through(record)
+        if freed < 0:
+            return False
+        self.total_bytes -= freed
+        return True
+
+    def drop(self, chat_id: int):
+        """Выгружает чат из RAM"""
+        chat = self._chats.pop(chat_id, None)
+        if chat is not None:
+            self.total_bytes -= chat.nbytes
+
+    def items(self):
+        """Пары (chat_id, список сообщений) для всех загруженных чатов"""
+        return [(chat_id, list(chat)) for chat_id, chat in self._chats.items()]
+
+    def chat_bytes(self, chat_id: int) -> int:
+        chat = self._chats.get(chat_id)
+        return chat.nbytes if chat is not None else 0
+
+    def _evict(self, keep: int):
+        while self.total_bytes > self.max_bytes and len(self._chats) > 1:
+            chat_id = next(iter(self._chats))
+            if chat_id == keep:
+                self._chats.move_to_end(chat_id)
+                continue
+            self.drop(chat_id)
+            self.evictions += 1
+
+
+memory_buffer = MemoryStore(MEMORY_MAX_BYTES)
+
+
+async def add_to_memory(chat_id, role, text, timestamp=None):
+    """Добавляет сообщение в краткосрочную память чата с временной меткой"""
+    # Чат ещё не в RAM (или вытеснен) — сначала подгружаем его историю
+    if chat_id not in memory_buffer:
+        await get_memory(chat_id)
+
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc)
+
+    # Буфер чата кольцевой: при переполнении старое сообщение вытесняется само,
+    # summary делаем отдельно в хэндлере
+    memory_buffer.append(chat_id, MemoryRecord(role, text, timestamp.timestamp()))
+
+    # Сохраняем сообщение в БД для постоянного хранения (пакетной записью в фоне)
+    await message_writer.put(chat_id, role, text, timestamp)
+
+
+async def _load_memory(chat_id: int) -> ChatMemory:
+    # Сообщения из очереди записи тоже попадают в выборку (без внеочередной записи)
+    records = await message_writer.load(chat_id, limit=MAX_MEMORY)
+    memory_buffer.db_loads += 1
+    return memory_buffer.load(chat_id, records)
+
+
+async def get_memory(chat_id):
+    """
+    Возвращает краткосрочную память чата (автозагрузка из БД при первом обращении).
+
+    Из БД чат загружается один раз, пока он в RAM, — даже если история пуста.
+    Одновременные обращения к ещё не загруженному чату ждут одну общую загрузку.
+    """
+    chat = memory_buffer.get(chat_id)
+    if chat is not None:
+        memory_buffer.hits += 1
+        return chat
+
+    task = memory_buffer._loading.get(chat_id)
+    if task is None:
+        task = asyncio.create_task(_load_memory(chat_id))
+        memory_buffer._loading[chat_id] = task
+        task.add_done_callback(lambda _: memory_buffer._loading.pop(chat_id, None))
+
+    # shield: отмена одного из ожидающих не должна отменять общую загрузку
+    return await asyncio.shield(task)
+
+
+# -------------------------
+#   ДОЛГОСРОЧНАЯ ПАМЯТЬ: ПОИСК
+# -------------------------
+
+TERM_RE = re.compile(r"\w+")
+
+
+def memory_terms(text: str) -> bytes:
+    """
+    Термины текста для хешированного TF-IDF.
+
+    Для каждого слова от 3 символов (в нижнем регистре) — его первые
+    5 символов и символьные триграммы слова с границами: так «кот», «кота»
+    и «коту» остаются похожими без морфологического словаря. Термины
+    хешируются crc32 в 16 бит (это и есть корзины вектора), повторы
+    сохраняются — из них считается tf.
+    """
+    hashes = array("H")
+    for word in TERM_RE.findall(text.lower()):
+        if len(word) < 3:
+            continue
+        hashes.append(zlib.crc32(word[:5].encode("utf-8")) & 0xFFFF)
+        padded = f" {word} "
+        hashes.extend(zlib.crc32(padded[i:i + 3].encode("utf-8")) & 0xFFFF for i in range(len(padded) - 2))
+    return hashes.tobytes()
+
+
+class ChatIndex:
+    """
+    Индекс архива одного чата для хешированного TF-IDF.
+
+    Вектор записи — log(1 + tf) по 16-битным хешам терминов, нормированный
+    к единичной длине; idf применяется только к вектору вопроса, поэтому
+    новые записи добавляются без пересчёта старых. Векторы хранятся
+    разреженно — сегментами постингов (корзина, номер записи, вес),
+    отсортированных по корзине, — и вопрос читает только постинги своих
+    терминов, а не всю матрицу. Каждое добавление — новый сегмент; соседние
+    сегменты сравнимого размера сливаются, так что сегментов O(log n).
+    """
+
+    __slots__ = ("ids", "count", "df", "segments", "nbytes")
+
+    BUCKETS = 1 << 16          # хеши терминов 16-битные
+    QUERY_POSTINGS = 150_000   # сколько постингов читать на вопрос (начиная с самых редких терминов)
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.count = 0
+        self.df = np.zeros(self.BUCKETS, dtype=np.float32)
+        self.segments = []  # [(корзины, номера записей, веса)], отсортированы по корзине
+        self.nbytes = self.ids.nbytes + self.df.nbytes
+
+    @classmethod
+    def postings(cls, terms_list, first_row: int):
+        """Постинги (корзины, номера записей, веса) для терминов записей, отсортированные по корзине"""
+        lengths = np.fromiter((len(terms) // 2 for terms in terms_list), dtype=np.int64, count=len(terms_list))
+        buckets = np.frombuffer(b"".join(terms_list), dtype=np.uint16)
+        rows = np.repeat(np.arange(len(terms_list), dtype=np.int64), lengths)
+        keys, tf = np.unique(rows * cls.BUCKETS + buckets, return_counts=True)
+        rows = keys // cls.BUCKETS
+        weights = np.log1p(tf, dtype=np.float32)
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(terms_list)))
+        weights /= norms[rows]
+        buckets = (keys % cls.BUCKETS).astype(np.uint16)
+        order = np.argsort(buckets, kind="stable")  # для 16-битных ключей — поразрядная сортировка
+        return buckets[order], (rows[order] + first_row).astype(np.int32), weights[order]
+
+    @classmethod
+    def build(cls, rows) -> "ChatIndex":
+        """Индекс из строк (id, термины) по возрастанию id"""
+        index = cls()
+        index.add(rows)
+        return index
+
+    def add(self, rows):
+        """Добавляет записи (id, термины); уже проиндексированные пропускает"""
+        last = self.ids[self.count - 1] if self.count else -1
+        rows = [row for row in rows if row[0] > last]
+        if not rows:
+            return
+        segment = self.postings([terms for _, terms in rows], self.count)
+        self.ids = np.concatenate((self.ids[:self.count], [row_id for row_id, _ in rows]))
+        self.count = len(self.ids)
+        self.df += np.bincount(segment[0], minlength=self.BUCKETS)
+
+        self.segments.append(segment)
+        while len(self.segments) > 1 and len(self.segments[-2][0]) <= 2 * len(self.segments[-1][0]):
+            merged = [np.concatenate(parts) for parts in zip(self.segments.pop(-2), self.segments.pop())]
+            order = np.argsort(merged[0], kind="stable")
+            self.segments.append(tuple(part[order] for part in merged))
+        self.nbytes = (self.ids.nbytes + self.df.nbytes +
+                       sum(part.nbytes for segment in self.segments for part in segment))
+
+    def search(self, terms: bytes, k: int, min_score: float):
+        """
+        Returns:
+            [(id записи, сходство)] по убыванию сходства, не больше k
+        """
+        if not self.count or not terms:
+            return []
+        buckets, tf = np.unique(np.frombuffer(terms, dtype=np.uint16), return_counts=True)
+        weights = np.log1p(tf, dtype=np.float32) * (np.log((1 + self.count) / (1 + self.df[buckets])) + 1)
+        weights /= np.linalg.norm(weights)
+        # Частые термины (имена авторов, «как», «что») дают почти нулевой вклад из-за idf,
+        # но читать их постинги дороже всего — на больших чатах их пропускаем
+        df = self.df[buckets]
+        order = np.argsort(df)
+        keep = order[np.cumsum(df[order]) <= self.QUERY_POSTINGS]
+        buckets, weights = buckets[keep], weights[keep]
+
+        scores = np.zeros(self.count, dtype=np.float64)
+        for segment_buckets, segment_rows, segment_weights in self.segments:
+            starts = np.searchsorted(segment_buckets, buckets, side="left")
+            lengths = np.searchsorted(segment_buckets, buckets, side="right") - starts
+            total = lengths.sum()
+            if not total:
+                continue
+            # Позиции постингов всех терминов вопроса одним массивом
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.repeat(starts - offsets, lengths) + np.arange(total)
+            scores += np.bincount(segment_rows[positions],
+                                  weights=segment_weights[positions] * np.repeat(weights, lengths),
+                                  minlength=self.count)
+
+        # Top-k только среди записей выше порога: argpartition на массиве
+        # из одних нулей в разы медленнее
+        candidates = np.flatnonzero((scores > 0) & (scores >= min_score))
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+        top = candidates[np.argsort(scores[candidates])[::-1]]
+        return [(int(self.ids[i]), float(scores[i])) for i in top]
+
+
+class MemoryIndex:
+    """
+    Семантический поиск по долгосрочной памяти чата: сводкам и сообщениям,
+    которые уже свернули из краткосрочной памяти (таблица memory_archive).
+
+    Индекс чата строится из БД при первом поиске (в потоке читателя) и
+    дальше пополняется инкрементально из save_summary. Записи, сохранённые
+    во время построения, догоняют его после загрузки. Индексы давно
+    не спрашивавшихся чатов выгружаются, когда все вместе занимают больше
+    max_bytes (LRU, как memory_buffer).
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()  # chat_id -> ChatIndex
+        self._loading = {}           # chat_id -> задача построения
+        self._pending = {}           # chat_id -> записи, сохранённые во время построения
+        self._clears = 0             # счётчик forget(), чтобы не сохранить устаревший индекс
+        self.total_bytes = 0
+        self.searches = 0
+        self.found = 0
+
+    @property
+    def enabled(self) -> bool:
+        return SEMANTIC_MEMORY
+
+    def add(self, chat_id: int, rows):
+        if not rows or not self.enabled:
+            return
+        index = self._chats.get(chat_id)
+        if index is not None:
+            self.total_bytes -= index.nbytes
+            index.add(rows)
+            self.total_bytes += index.nbytes
+            self._evict(keep=chat_id)
+        elif chat_id in self._loading:
+            self._pending.setdefault(chat_id, []).extend(rows)
+
+    def forget(self, chat_id: int):
+        self._drop(chat_id)
+        self._pending.pop(chat_id, None)
+        self._clears += 1
+
+    def _drop(self, chat_id: int):
+        index = self._chats.pop(chat_id, None)
+        if index is not None:
+            self.total_bytes -= index.nbytes
+
+    def _evict(self, keep: int):
+        while self.total_bytes > self.max_bytes and len(self._chats) > 1:
+            chat_id = next(iter(self._chats))
+            if chat_id == keep:
+                self._chats.move_to_end(chat_id)
+                continue
+            self._drop(chat_id)
+
+    async def _build(self, chat_id: int) -> ChatIndex:
+        clears = self._clears
+        index = await storage.read(_load_memory_archive, chat_id)
+        index.add(self._pending.pop(chat_id, ()))
+        if self._clears == clears:
+            self._drop(chat_id)
+            self._chats[chat_id] = index
+            self.total_bytes += index.nbytes
+            self._evict(keep=chat_id)
+        return index
+
+    async def _index(self, chat_id: int) -> ChatIndex:
+        index = self._chats.get(chat_id)
+        if index is not None:
+            self._chats.move_to_end(chat_id)
+            return index
+
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._build(chat_id))
+            self._loading[chat_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def search(self, chat_id: int, text: str, k: int = SEMANTIC_TOP_K):
+        """
+        Воспоминания чата, похожие на text.
+
+        Returns:
+            [(id записи, вид записи, текст, unix-время, сходство)] по убыванию сходства
+        """
+        if not self.enabled:
+            return []
+        terms = memory_terms(text)
+        if not terms:
+            return []
+        index = await self._index(chat_id)
+
+        started = time.perf_counter()
+        hits = index.search(terms, k, SEMANTIC_MIN_SCORE)
+        memory_search_seconds.observe(time.perf_counter() - started)
+        self.searches += 1
+        if not hits:
+            return []
+
+        rows = await storage.read(_load_archived, [row_id for row_id, _ in hits])
+        found = [(row_id, *rows[row_id], score) for row_id, score in hits if row_id in rows]
+        self.found += len(found)
+        return found
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return "выключен"
+        records = sum(index.count for index in self._chats.values())
+        return (f"поисков {self.searches}, найдено воспоминаний {self.found}, "
+                f"индексов в RAM {len(self._chats)} ({records} записей, "
+                f"{self.total_bytes / 1024 / 1024:.1f} МБ)")
+
+
+memory_index = MemoryIndex(SEMANTIC_CACHE_BYTES)
+
+
+# -------------------------
+#        ИНИЦИАЛИЗАЦИЯ
+# -------------------------
+
+load_dotenv()
+
+TOKEN = os.getenv("TELEGRAM_TOKEN")
+OPENROUTER_KEY = os.getenv("OPENROUTER_KEY")
+
+# Проверка наличия обязательных переменных окружения
+if not TOKEN:
+    raise ValueError(
+        "❌ TELEGRAM_TOKEN не найден!\n"
+        "Установите переменную окружения TELEGRAM_TOKEN в Railway Dashboard (Settings → Variables)"
+    )
+if not OPENROUTER_KEY:
+    raise ValueError(
+        "❌ OPENROUTER_KEY не найден!\n"
+        "Установите переменную окружения OPENROUTER_KEY в Railway Dashboard (Settings → Variables)"
+    )
+
+bot = Bot(token=TOKEN)
+dp = Dispatcher()
+
+
+class BotIdentity:
+    """id и username бота с заранее скомпилированным поиском упоминания @username"""
+
+    __slots__ = ("id", "username", "mention")
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.mention = re.compile(rf"@{re.escape(user.username)}\b", re.IGNORECASE)
+
+
+bot_identity = None  # заполняется в main(); до этого — при первом обращении
+
+
+async def get_bot_identity() -> BotIdentity:
+    """Один запрос getMe на весь процесс (повторно — только если ещё не удалось)"""
+    global bot_identity
+    if bot_identity is None:
+        bot_identity = BotIdentity(await bot.get_me())
+    return bot_identity
+
+
+# -------------------------
+#   ОТПРАВКА В TELEGRAM
+# -------------------------
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # сообщений в секунду на весь бот
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))       # сообщений в секунду в личный чат
+TELEGRAM_GROUP_RATE = 20 / 60                                          # в группу — 20 сообщений в минуту
+TELEGRAM_CHAT_BURST = 3                                                # подряд в один чат без ожидания
+TELEGRAM_BUCKETS = 10000                                               # чатов с отдельным лимитом в RAM
+
+PRIORITY_REPLY = 0  # ответы и финальные правки
+PRIORITY_EDIT = 1   # промежуточные правки стриминга и клавиатур
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    """Делит текст на части не длиннее лимита Telegram, по возможности по переносам строк"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate отправок в секунду, до burst подряд.
+
+    Ожидающие обслуживаются по приоритету (меньше — раньше), при равном —
+    по порядку прихода. block() останавливает выдачу токенов, например
+    на время RetryAfter от Telegram.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters = []             # куча (приоритет, номер, future)
+        self._seq = 0
+        self._task = None
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def idle(self) -> bool:
+        """Ведро полное и никто не ждёт — его можно выбросить без потери лимита"""
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst and self.blocked_until <= self.updated
+
+    def try_acquire(self) -> bool:
+        """Берёт токен, только если он есть сразу и никто не стоит в очереди"""
+        now = self._refill()
+        if self._waiters or now < self.blocked_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def refund(self):
+        """Возвращает токен, взятый try_acquire, если запрос так и не ушёл"""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    async def acquire(self, priority: int = PRIORITY_REPLY):
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._release())
+        await future
+
+    async def _release(self):
+        try:
+            while self._waiters:
+                now = self._refill()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    continue
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    # Ожидающего отменили — токен достаётся следующему
+                    continue
+                self.tokens -= 1
+                future.set_result(None)
+        finally:
+            self._task = None
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TelegramOutbox:
+    """
+    Все отправки и правки сообщений бота.
+
+    Каждая отправка берёт токен из ведра своего чата (личка — TELEGRAM_CHAT_RATE,
+    группа — TELEGRAM_GROUP_RATE) и из общего ведра TELEGRAM_GLOBAL_RATE,
+    так что при всплеске сообщения уходят с потолочной скоростью Telegram,
+    а не получают flood control. Ответы идут вперёд правок. При RetryAfter
+    чат ставится на паузу на указанное время и запрос повторяется;
+    промежуточные правки стриминга (droppable) вместо ожидания пропускаются —
+    следующая всё равно покажет свежий текст. Тексты длиннее лимита Telegram
+    отправляются несколькими сообщениями.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, burst: float, max_buckets: int):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = OrderedDict()  # chat_id -> TokenBucket
+        self.sent = 0
+        self.retries = 0
+        self.dropped = 0
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы и каналы
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst)
+            if len(self._buckets) > self.max_buckets:
+                # Простаивающие ведра забываем все: по порядку использования
+                # впереди может стоять и чат, который ещё ждёт лимита
+                for idle_id in [cid for cid, b in self._buckets.items() if cid != chat_id and b.idle()]:
+                    del self._buckets[idle_id]
+        self._buckets.move_to_end(chat_id)
+        return bucket
+
+    async def call(self, chat_id: int, request, priority: int = PRIORITY_REPLY, droppable: bool = False):
+        """
+        Выполняет запрос к Telegram в рамках лимитов.
+
+        Args:
+            request: функция без аргументов, возвращающая корутину запроса
+                     (после RetryAfter вызывается повторно)
+            droppable: не ждать лимита и не повторять — при нехватке вернуть None
+        """
+        bucket = self._bucket(chat_id)
+        method = getattr(getattr(request, "func", None), "__name__", "request")
+        with tracer.span("telegram", method=method) as span:
+            while True:
+                if droppable:
+                    acquired = bucket.try_acquire()
+                    if acquired and not self._global.try_acquire():
+                        # Общий лимит исчерпан — токен чата возвращаем, правка не уйдёт
+                        bucket.refund()
+                        acquired = False
+                    if not acquired:
+                        self.dropped += 1
+                        span.set(dropped=True)
+                        return None
+                else:
+                    await bucket.acquire(priority)
+                    await self._global.acquire(priority)
+
+                try:
+                    result = await request()
+                    self.sent += 1
+                    return result
+                except TelegramRetryAfter as e:
+                    print(f"🐢 Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                    span.set(retry_after=e.retry_after)
+                    bucket.block(e.retry_after)
+                    if droppable:
+                        self.dropped += 1
+                        return None
+                    self.retries += 1
+
+    async def send(self, chat_id: int, send_fn, text: str, **kwargs):
+        """Отправляет текст (длинный — частями); клавиатура и прочее — к последней части"""
+        parts = split_message(text)
+        sent = None
+        for i, part in enumerate(parts):
+            options = kwargs if i == len(parts) - 1 else {}
+            sent = await self.call(chat_id, partial(send_fn, part, **options))
+        return sent
+
+    async def answer(self, message: Message, text: str, **kwargs):
+        return await self.send(message.chat.id, message.answer, text, **kwargs)
+
+    async def reply(self, message: Message, text: str, **kwargs):
+        return await self.send(message.chat.id, message.reply, text, **kwargs)
+
+    async def edit(self, message: Message, text: str, priority: int = PRIORITY_EDIT, droppable: bool = False,
+                   **kwargs):
+        return await self.call(message.chat.id, partial(message.edit_text, text, **kwargs), priority, droppable)
+
+
+outbox = TelegramOutbox(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    group_rate=TELEGRAM_GROUP_RATE,
+    burst=TELEGRAM_CHAT_BURST,
+    max_buckets=TELEGRAM_BUCKETS,
+)
+
+
+# -------------------------
+#   OPENROUTER: HTTP КЛИЕНТ
+# -------------------------
+
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")  # свой адрес — для нагрузочных тестов
+
+OPENROUTER_HTTP2 = os.getenv("OPENROUTER_HTTP2", "1") == "1"                      # HTTP/2, если установлен пакет h2
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "20"))   # всего соединений в пуле
+OPENROUTER_MAX_KEEPALIVE = int(os.getenv("OPENROUTER_MAX_KEEPALIVE", "10"))       # из них держим открытыми
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))  # сек на TCP+TLS
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "60"))       # сек между байтами ответа
+OPENROUTER_TOTAL_TIMEOUT = float(os.getenv("OPENROUTER_TOTAL_TIMEOUT", "90"))     # сек на весь запрос
+
+
+class OpenRouterError(Exception):
+    """Ошибка OpenRouter в потоковом ответе (тело ошибки и подсказка Retry-After)"""
+
+    def __init__(self, data: dict, retry_after: str = None):
+        super().__init__(data)
+        self.data = data
+        self.retry_after = retry_after
+
+
+# Отказы провайдера и сети: сеть, HTTP, таймауты, ошибка в теле или не-JSON вместо ответа.
+# Только они засчитываются модели в ошибки — прочие исключения это ошибки самого бота
+MODEL_ERRORS = (OpenRouterError, httpx.HTTPError, TimeoutError, json.JSONDecodeError)
+
+
+class OpenRouterClient:
+    """
+    Общий для всего бота HTTP клиент OpenRouter.
+
+    Одно долгоживущее соединение (keep-alive, по возможности HTTP/2)
+    вместо нового httpx.AsyncClient и TLS рукопожатия на каждый запрос.
+    Создаётся в main() и закрывается при graceful shutdown; если main()
+    не вызывался (скрипты, бенчмарки), клиент создаётся при первом запросе.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    def start(self):
+        if self._client is not None:
+            return
+
+        http2 = OPENROUTER_HTTP2 and importlib.util.find_spec("h2") is not None
+        if OPENROUTER_HTTP2 and not http2:
+            print("⚠️  Пакет h2 не установлен, OpenRouter работает по HTTP/1.1")
+
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_KEY}",
+                "Content-Type": "application/json",
+                "Referer": "https://github.com/Urma1/GhostAI",
+                "X-Title": "GhostAI Bot"
+            },
+            limits=httpx.Limits(
+                max_connections=OPENROUTER_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE,
+                keepalive_expiry=60.0
+            ),
+            timeout=httpx.Timeout(
+                connect=OPENROUTER_CONNECT_TIMEOUT,
+                read=OPENROUTER_READ_TIMEOUT,
+                write=OPENROUTER_CONNECT_TIMEOUT,
+                pool=OPENROUTER_CONNECT_TIMEOUT
+            )
+        )
+
+    async def post(self, body: dict, total_timeout: float = OPENROUTER_TOTAL_TIMEOUT) -> httpx.Response:
+        """POST в chat/completions с ограничением на общее время запроса"""
+        self.start()
+        return await asyncio.wait_for(self._post(body), timeout=total_timeout)
+
+    async def _post(self, body: dict) -> httpx.Response:
+        model = MODEL_KEYS.get(body["model"], body["model"])
+        with tracer.span("openrouter", model=model) as span:
+            started = time.monotonic()
+            response = await self._client.send(self._client.build_request("POST", OPENROUTER_URL, json=body),
+                                               stream=True)
+            ttfb = time.monotonic() - started
+            llm_ttfb.observe(ttfb, model)
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            llm_duration.observe(time.monotonic() - started, model)
+            span.set(status=response.status_code, ttfb_ms=round(ttfb * 1000, 1))
+        return response
+
+    async def stream(self, body: dict):
+        """
+        Запрос со stream=True: отдаёт куски текста по мере генерации (SSE).
+
+        Общий таймаут здесь не действует — длинная история может генерироваться
+        минутами, — но между кусками действует OPENROUTER_READ_TIMEOUT.
+        При ошибке провайдера (в том числе посреди потока) бросает OpenRouterError.
+        """
+        self.start()
+        model = MODEL_KEYS.get(body["model"], body["model"])
+        started = time.monotonic()
+        first = True
+        async with self._client.stream("POST", OPENROUTER_URL, json={**body, "stream": True}) as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                try:
+                    data = resp.json()
+                except ValueError:
+                    data = {"error": {"code": resp.status_code, "message": resp.text}}
+                raise OpenRouterError(data, resp.headers.get("Retry-After"))
+
+            async for line in resp.aiter_lines():
+                # Пустые строки и комментарии вида ": OPENROUTER PROCESSING" пропускаем
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+
+                chunk = json.loads(payload)
+                if "error" in chunk:
+                    raise OpenRouterError(chunk)
+
+                choices = chunk.get("choices") or []
+                if choices:
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        if first:
+                            llm_ttfb.observe(time.monotonic() - started, model)
+                            first = False
+                        yield delta
+
+            llm_duration.observe(time.monotonic() - started, model)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+openrouter = OpenRouterClient()
+
+
+# -------------------------
+#   ЗДОРОВЬЕ МОДЕЛЕЙ
+# -------------------------
+
+class ModelHealth:
+    """
+    Circuit breaker и статистика одной модели.
+
+    closed    — модель работает, запросы идут как обычно
+    open      — модель недавно падала (rate limit, 5xx, много ошибок подряд),
+                запросы к ней пропускаются до open_until
+    half-open — время блокировки вышло, следующий запрос (живой или фоновая
+                проверка) решает: успех закрывает breaker, ошибка снова открывает
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)     # True — успех, False — ошибка
+        self.latencies = deque(maxlen=LATENCY_WINDOW)    # сек, только успешные ответы целиком
+        self.first_tokens = deque(maxlen=LATENCY_WINDOW)  # сек до первого куска успешных потоков
+        self.latency_ewma = None
+        self.open_until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = False
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def available(self) -> bool:
+        """Можно ли отправлять запросы (переводит open → half-open по истечении блокировки)"""
+        if self.state == self.OPEN and time.monotonic() >= self.open_until:
+            self.state = self.HALF_OPEN
+        return self.state != self.OPEN
+
+    def record_success(self, seconds: float, first_token: float = None):
+        """
+        Args:
+            seconds: время до полного ответа
+            first_token: для потока — время до первого куска; такие ответы
+                         не попадают в latencies, по которым считается hedge_delay
+        """
+        llm_requests.inc(self.name, "ok")
+        self.outcomes.append(True)
+        if first_token is None:
+            self.latencies.append(seconds)
+        else:
+            self.first_tokens.append(first_token)
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += BREAKER_EWMA_ALPHA * (seconds - self.latency_ewma)
+
+        if self.state != self.CLOSED:
+            print(f"🟢 Модель {self.name} снова доступна")
+            self.state = self.CLOSED
+            self.cooldown = BREAKER_COOLDOWN
+
+    def record_failure(self, retry_after: float = None, hard: bool = False):
+        """
+        Args:
+            retry_after: через сколько секунд провайдер просит повторить
+            hard: ошибка доступности (429/502/503) — открываем breaker сразу
+        """
+        llm_requests.inc(self.name, "unavailable" if hard else "error")
+        self.outcomes.append(False)
+        too_many_errors = (
+            len(self.outcomes) >= BREAKER_MIN_CALLS
+            and self.error_rate >= BREAKER_ERROR_RATE
+        )
+        if hard or too_many_errors or self.state == self.HALF_OPEN:
+            self.trip(retry_after)
+
+    def trip(self, retry_after: float = None):
+        """Открывает breaker; без подсказки провайдера блокировка растёт экспоненциально"""
+        if retry_after:
+            delay = min(retry_after, BREAKER_MAX_COOLDOWN)
+        else:
+            delay = self.cooldown
+            if self.state != self.CLOSED:
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+
+        self.state = self.OPEN
+        self.open_until = time.monotonic() + delay
+        print(f"🔴 Модель {self.name} отключена на {delay:.0f} с")
+
+    def score(self) -> float:
+        """Чем меньше, тем лучше: задержка с поправкой на долю ошибок"""
+        latency = self.latency_ewma if self.latency_ewma is not None else HEDGE_DELAY_DEFAULT
+        return latency * (1 + 4 * self.error_rate)
+
+    def describe(self) -> str:
+        """Строка для /stats"""
+        self.available()
+        icon = {self.CLOSED: "🟢", self.HALF_OPEN: "🟡", self.OPEN: "🔴"}[self.state]
+        latency = f"~{self.latency_ewma:.1f} с" if self.latency_ewma is not None else "нет данных"
+        text = f"{icon} {self.name}: {self.state}, {latency}, ошибок {self.error_rate:.0%}"
+        if self.state == self.OPEN:
+            text += f", ещё {self.open_until - time.monotonic():.0f} с"
+        return text
+
+
+model_health = {name: ModelHealth(name) for name in AVAILABLE_MODELS}
+
+
+def parse_retry_after(error_data, header: str = None):
+    """Достаёт из ошибки OpenRouter, через сколько секунд можно повторить запрос"""
+    candidates = [header]
+    reset = None
+
+    error = error_data.get("error") if isinstance(error_data, dict) else None
+    if isinstance(error, dict):
+        metadata = error.get("metadata")
+        headers = metadata.get("headers") if isinstance(metadata, dict) else None
+        if isinstance(headers, dict):
+            candidates.append(headers.get("Retry-After") or headers.get("retry-after"))
+            reset = headers.get("X-RateLimit-Reset")
+
+    for value in candidates:
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            continue
+        if seconds > 0:
+            return seconds
+
+    # X-RateLimit-Reset — момент сброса лимита в миллисекундах epoch
+    try:
+        seconds = float(reset) / 1000 - time.time()
+    except (TypeError, ValueError):
+        return None
+    return seconds if seconds > 0 else None
+
+
+def order_models(preferred_model: str):
+    """
+    Порядок моделей для fallback по живому здоровью.
+
+    Модели с открытым breaker пропускаются. Предпочитаемая модель идёт первой,
+    если она в порядке, дальше — здоровые по score, затем half-open.
+    Если отключены все, пробуем их в порядке скорейшего восстановления.
+    """
+    usable = [name for name in AVAILABLE_MODELS if model_health[name].available()]
+    if not usable:
+        return sorted(AVAILABLE_MODELS, key=lambda name: model_health[name].open_until)
+
+    def rank(name):
+        health = model_health[name]
+        return (
+            health.state != ModelHealth.CLOSED,
+            name != preferred_model,
+            health.score()
+        )
+
+    return sorted(usable, key=rank)
+
+
+async def probe_model(model_name: str):
+    """Минимальный запрос к half-open модели, чтобы решить судьбу breaker"""
+    health = model_health[model_name]
+    health.probing = True
+    started = time.monotonic()
+    try:
+        resp = await openrouter.post(
+            {
+                "model": AVAILABLE_MODELS[model_name],
+                "messages": [{"role": "user", "content": "ping"}],
+                "max_tokens": 1
+            },
+            total_timeout=BREAKER_PROBE_TIMEOUT
+        )
+        data = resp.json()
+        if "choices" in data:
+            health.record_success(time.monotonic() - started)
+        else:
+            health.record_failure(parse_retry_after(data, resp.headers.get("Retry-After")))
+    except Exception as e:
+        print(f"⚠️  Проверка модели {model_name} не удалась: {e}")
+        health.record_failure()
+    finally:
+        health.probing = False
+
+
+async def breaker_probe_loop():
+    """
+    Фоновая проверка отключённых моделей (запускается из main()).
+
+    Ссылки на задачи проверок держим, пока они идут (иначе их может собрать
+    GC), и отменяем вместе с циклом.
+    """
+    probes = set()
+    try:
+        while True:
+            await asyncio.sleep(BREAKER_PROBE_INTERVAL)
+            for name, health in model_health.items():
+                if health.available() and health.state == ModelHealth.HALF_OPEN and not health.probing:
+                    task = asyncio.create_task(probe_model(name))
+                    probes.add(task)
+                    task.add_done_callback(probes.discard)
+    finally:
+        for task in probes:
+            task.cancel()
+
+
+# -------------------------
+#   AI: SUMMARY ДЛЯ ПАМЯТИ
+# -------------------------
+
+@traced("summarize_chat", root=True)
+async def summarize_chat(chat_id: int):
+    """
+    Делает краткое summary из переписки и сохраняет в БД.
+
+    Пока идёт запрос к модели, в чат могут прийти новые сообщения, поэтому
+    после ответа из буфера убирается ровно то, что попало в сводку: всё до
+    последнего свёрнутого сообщения включительно (ищем его по ссылке на объект).
+    Если его в буфере уже нет — чат успели очистить, и сводка не сохраняется.
+    При ошибке OpenRouter бросает OpenRouterError, чтобы очередь повторила попытку.
+    """
+    tracer.annotate(chat_id=chat_id)
+    with tracer.span("get_memory"):
+        history = await get_memory(chat_id)
+    if not history:
+        return
+
+    # Берём всё, кроме хвоста, чтобы хвост оставить для живого контекста
+    if len(history) <= TAIL_AFTER_SUMMARY:
+        return
+
+    to_summarize = history[:-TAIL_AFTER_SUMMARY]
+    boundary = to_summarize[-1]
+
+    # Собираем текст истории для свёртки
+    conversation_text = "\n".join(
+        f"{m.role}: {m.content}" for m in to_summarize
+    )
+
+    body = {
+        "model": "deepseek/deepseek-chat:free",
+        "messages": [
+            {
+                "role": "system",
+                "content": (
+                    "Ты делаешь очень краткую сводку переписки в чате. "
+                    "Сжато опиши, что обсуждали, кто с кем спорил, какие важные факты и решения были. "
+                    "Пиши 3–6 коротких предложений, без лишних деталей."
+                )
+            },
+            {
+                "role": "user",
+                "content": conversation_text
+            }
+        ]
+    }
+
+    resp = await openrouter.post(body)
+    print("SUMMARY RESPONSE:", resp.text)
+    data = resp.json()
+    if "choices" not in data:
+        raise OpenRouterError(data, resp.headers.get("Retry-After"))
+    summary = data["choices"][0]["message"]["content"]
+
+    current = memory_buffer.get(chat_id)
+    if current is None or not any(m is boundary for m in current):
+        print(f"⚠️  Память чата {chat_id} изменилась во время summary, сводка отброшена")
+        return
+
+    # сохраняем summary в БД
+    with tracer.span("save_summary"):
+        await save_summary(chat_id, summary, to_summarize)
+
+    # в краткосрочной памяти оставляем хвост и всё, что пришло за время summary
+    memory_buffer.drop_through(chat_id, boundary)
+
+
+async def merge_summaries(summaries, level: int) -> str:
+    """Сливает несколько сводок (старые → новые) в одну сводку уровня level"""
+    body = {
+        "model": "deepseek/deepseek-chat:free",
+        "messages": [
+            {
+                "role": "system",
+                "content": (
+                    "Тебе дают несколько сводок прошлых разговоров в чате, от старых к новым. "
+                    "Объедини их в одну сводку: сохрани важные факты, решения, договорённости и кто что говорил, "
+                    "убери повторы и мелочи. "
+                    f"Пиши не больше {4 + 2 * min(level, 2)} коротких предложений."
+                )
+            },
+            {
+                "role": "user",
+                "content": "\n\n".join(f"Сводка {i}: {text}" for i, text in enumerate(summaries, start=1))
+            }
+        ]
+    }
+
+    resp = await openrouter.post(body)
+    data = resp.json()
+    if "choices" not in data:
+        raise OpenRouterError(data, resp.headers.get("Retry-After"))
+    return data["choices"][0]["message"]["content"]
+
+
+@traced("compact_summaries", root=True)
+async def compact_summaries(chat_id: int) -> int:
+    """
+    Иерархическое слияние сводок чата.
+
+    Если на уровне больше SUMMARY_LEVEL_LIMIT сводок, самые старые
+    SUMMARY_LEVEL_LIMIT из них сливаются в одну сводку уровнем выше (на
+    SUMMARY_MAX_LEVEL — в том же уровне). Сливаются всегда самые старые,
+    поэтому каждый уровень покрывает историю давнее любого уровня ниже, а
+    на каждом уровне остаётся не больше SUMMARY_LEVEL_LIMIT сводок — промпт
+    получает ограниченный набор, покрывающий всю историю чата.
+
+    За вызов — не больше одного слияния на уровень (снизу вверх), чтобы
+    накопленный хвост (например, после смены SUMMARY_LEVEL_LIMIT) не занял
+    воркер очереди надолго; остаток доделают следующие сводки чата.
+
+    Returns:
+        число выполненных слияний
+    """
+    tracer.annotate(chat_id=chat_id)
+    merges = 0
+    counts = await storage.read(_count_summaries_by_level, chat_id)
+    for level in sorted(counts):
+        if counts[level] <= SUMMARY_LEVEL_LIMIT:
+            continue
+
+        rows = await storage.read(_load_oldest_summaries, chat_id, level, SUMMARY_LEVEL_LIMIT)
+        target = min(level + 1, SUMMARY_MAX_LEVEL)
+        with tracer.span("merge", level=level, count=len(rows)):
+            merged = await merge_summaries([text for _, text in rows], target)
+
+        if not await storage.write(_replace_summaries, chat_id, [row_id for row_id, _ in rows], merged, target):
+            print(f"⚠️  Сводки чата {chat_id} изменились во время слияния, результат отброшен")
+            return merges
+        prompt_cache.invalidate_summaries(chat_id)
+        merges += 1
+        counts[level] -= len(rows)
+        counts[target] = counts.get(target, 0) + 1
+        print(f"🗜️  Чат {chat_id}: {len(rows)} сводок уровня {level} слиты в уровень {target}")
+    return merges
+
+
+class SummaryQueue:
+    """
+    Фоновая очередь summary, чтобы свёртка не задерживала ответы.
+
+    Чат ставится в очередь не более одного раза: пока он ждёт или
+    сворачивается, повторные schedule() игнорируются. Свёртку выполняют
+    workers фоновых задач; при ошибке попытка повторяется с экспоненциальной
+    задержкой. После успешной свёртки тот же воркер сливает накопившиеся
+    сводки (compact_summaries), так что слияние одного чата не идёт
+    параллельно само с собой. Если очередь переполнена, чат пропускается —
+    его поставит в очередь следующее сообщение. Чаты с прошлого запуска
+    (resume) ждут места в очереди, а отметка «ждёт summary» снимается с них
+    только после успешной свёртки.
+    """
+
+    def __init__(self, workers: int, max_size: int, retries: int, retry_delay: float):
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._pending = set()  # чаты в очереди или в работе
+        self._resumed = set()  # чаты с отметкой «ждёт summary» с прошлого запуска
+        self._tasks = []
+        self.merges = 0        # слияний сводок в уровень выше
+
+    def start(self):
+        """Запускает фоновые задачи (вызывается из main())"""
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def schedule(self, chat_id: int):
+        if chat_id in self._pending:
+            return
+        try:
+            self._queue.put_nowait(chat_id)
+        except asyncio.QueueFull:
+            return
+        self._pending.add(chat_id)
+
+    async def resume(self, chat_ids):
+        """Ставит в очередь чаты, не свёрнутые при прошлой остановке"""
+        for chat_id in chat_ids:
+            self._resumed.add(chat_id)
+            if chat_id in self._pending:
+                continue
+            self._pending.add(chat_id)
+            await self._queue.put(chat_id)
+
+    def depth(self) -> int:
+        """Сколько чатов ждёт свёртки"""
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._queue.get()
+            try:
+                if await self._summarize_with_retry(chat_id):
+                    await self._unmark(chat_id)
+                    await self._compact(chat_id)
+            finally:
+                self._pending.discard(chat_id)
+                self._queue.task_done()
+
+    async def _summarize_with_retry(self, chat_id: int) -> bool:
+        for attempt in range(self.retries + 1):
+            try:
+                await summarize_chat(chat_id)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    print(f"❌ Не удалось сделать summary для чата {chat_id}: {e}")
+                    return False
+                delay = self.retry_delay * 2 ** attempt
+                print(f"⚠️  Ошибка summary для чата {chat_id}, повтор через {delay:.0f} с: {e}")
+                await asyncio.sleep(delay)
+
+    async def _unmark(self, chat_id: int):
+        if chat_id not in self._resumed:
+            return
+        self._resumed.discard(chat_id)
+        try:
+            await storage.write(_unmark_pending_summary, chat_id)
+        except Exception as e:
+            print(f"⚠️  Не удалось снять отметку «ждёт summary» с чата {chat_id}: {e}")
+
+    async def _compact(self, chat_id: int):
+        """Слияние сводок без повторов: не вышло сейчас — догонит после следующей свёртки"""
+        try:
+            self.merges += await compact_summaries(chat_id)
+        except Exception as e:
+            print(f"⚠️  Не удалось слить сводки чата {chat_id}: {e}")
+
+    async def stop(self):
+        """Останавливает фоновые задачи; незавершённые чаты свернёт save_all_memories"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+summary_queue = SummaryQueue(
+    workers=SUMMARY_WORKERS,
+    max_size=SUMMARY_QUEUE_SIZE,
+    retries=SUMMARY_RETRIES,
+    retry_delay=SUMMARY_RETRY_DELAY,
+)
+
+
+# -------------------------
+#  СОХРАНЕНИЕ ПАМЯТИ ПРИ ЗАВЕРШЕНИИ
+# -------------------------
+
+async def summarize_session(chat_id: int, history, timeout: float):
+    """Сводка всей истории чата (без деления на хвост) и снятие отметки «ждёт summary»"""
+    conversation_text = "\n".join(
+        f"{m.role}: {m.content}" for m in history
+    )
+
+    body = {
+        "model": "deepseek/deepseek-chat:free",
+        "messages": [
+            {
+                "role": "system",
+                "content": (
+                    "Ты делаешь краткую сводку переписки перед завершением сессии. "
+                    "Сжато опиши основные темы, важные факты и решения. "
+                    "3–5 коротких предложений."
+                )
+            },
+            {
+                "role": "user",
+                "content": conversation_text
+            }
+        ]
+    }
+
+    resp = await openrouter.post(body, total_timeout=timeout)
+    data = resp.json()
+    if "choices" not in data:
+        raise OpenRouterError(data, resp.headers.get("Retry-After"))
+
+    summary = data["choices"][0]["message"]["content"]
+    archived = await storage.write(_save_session_summary, chat_id, summary)
+    prompt_cache.invalidate_summaries(chat_id)
+    memory_index.add(chat_id, archived)
+
+
+async def summarize_sessions(chats: dict, deadline: float = None) -> int:
+    """
+    Сворачивает историю нескольких чатов параллельно (не больше
+    SESSION_SUMMARY_CONCURRENCY запросов одновременно).
+
+    Args:
+        chats: chat_id -> история
+        deadline: время loop.time(), к которому нужно успеть; незавершённые
+                  чаты остаются в pending_summaries до следующего запуска
+
+    Returns:
+        Сколько чатов успешно свёрнуто
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(SESSION_SUMMARY_CONCURRENCY)
+
+    async def summarize_one(chat_id, history):
+        async with semaphore:
+            timeout = SESSION_SUMMARY_TIMEOUT
+            if deadline is not None:
+                timeout = min(timeout, deadline - loop.time())
+                if timeout <= 0:
+                    return False
+            try:
+                await summarize_session(chat_id, history, timeout)
+                print(f"✅ Память чата {chat_id} сохранена")
+                return True
+            except Exception as e:
+                print(f"❌ Ошибка при сохранении чата {chat_id}: {e}")
+                return False
+
+    tasks = [asyncio.create_task(summarize_one(chat_id, history)) for chat_id, history in chats.items()]
+    if not tasks:
+        return 0
+
+    timeout = None if deadline is None else max(deadline - loop.time(), 0)
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    return sum(1 for task in done if task.result())
+
+
+def chats_to_summarize() -> dict:
+    """Чаты с активной памятью (пропускаем, если слишком мало сообщений): chat_id -> история"""
+    return {
+        chat_id: history
+        for chat_id, history in list(memory_buffer.items())
+        if history and len(history) >= 2
+    }
+
+
+async def mark_pending_memories(chats: dict = None):
+    """
+    Дёшево и локально: дописывает очередь сообщений в БД и отмечает чаты
+    как «ждёт summary», чтобы их свернул следующий запуск, даже если
+    процесс убьют до сводок.
+    """
+    if chats is None:
+        chats = chats_to_summarize()
+    try:
+        await message_writer.flush()
+        await storage.write(_mark_pending_summaries, list(chats))
+    except Exception as e:
+        print(f"❌ Не удалось сохранить память на диск: {e}")
+
+
+async def save_all_memories(deadline: float = None):
+    """
+    Сохраняет всю краткосрочную память в summary перед завершением бота.
+    Вызывается при получении сигнала остановки (SIGTERM/SIGINT).
+
+    Сначала дёшево и локально (mark_pending_memories), затем сворачиваем
+    чаты параллельно до deadline (loop.time(); по умолчанию через
+    SHUTDOWN_DEADLINE); что не успели — свернёт следующий запуск
+    (resume_pending_summaries).
+    """
+    print("🛑 Получен сигнал остановки. Сохраняю память всех чатов...")
+    loop = asyncio.get_running_loop()
+    if deadline is None:
+        deadline = loop.time() + SHUTDOWN_DEADLINE
+
+    # Останавливаем фоновые summary, чтобы не свернуть один чат дважды
+    await summary_queue.stop()
+
+    # 1. Сырые сообщения и отметки «ждёт summary» — на диск
+    # (повторно: за время дообработки апдейтов память могла появиться у новых чатов)
+    chats = chats_to_summarize()
+    await mark_pending_memories(chats)
+
+    # 2. Сводки — параллельно и до дедлайна
+    print(f"💾 Сворачиваю память {len(chats)} чатов (до {max(deadline - loop.time(), 0):.0f} с)")
+    saved = await summarize_sessions(chats, deadline)
+
+    if saved < len(chats):
+        print(f"⏳ Не успели свернуть {len(chats) - saved} чатов — они будут свёрнуты при следующем запуске")
+    print("✅ Все чаты сохранены. Завершаю работу...")
+
+
+async def resume_pending_summaries():
+    """
+    Сворачивает чаты, которые не успели свернуть при прошлой остановке
+    (в фоне из main()). Чаты идут через summary_queue, чтобы не свернуть
+    один чат параллельно с его обычной свёрткой.
+    """
+    try:
+        chat_ids = await storage.read(_load_pending_summaries)
+        if not chat_ids:
+            return
+
+        print(f"⏳ Досворачиваю память {len(chat_ids)} чатов с прошлого запуска")
+        await summary_queue.resume(chat_ids)
+    except Exception as e:
+        print(f"❌ Ошибка при досворачивании памяти: {e}")
+
+
+# -------------------------
+#     AI: КЕШ ОТВЕТОВ
+# -------------------------
+
+def normalize_for_cache(text: str) -> str:
+    """Регистр, лишние пробелы и финальная пунктуация не должны менять ключ кеша"""
+    return " ".join(text.lower().split()).rstrip("!?.…)")
+
+
+class ResponseCache:
+    """
+    Кеш ответов AI на одинаковые запросы.
+
+    Ключ — хеш модели, промпта стиля, сводок чата, найденных по вопросу
+    воспоминаний, последних RESPONSE_CACHE_CONTEXT сообщений чата и самого
+    вопроса после нормализации, поэтому "Привет!" в только что очищенном
+    чате отвечается из кеша, а тот же вопрос посреди разговора или после
+    новой сводки — нет. Время в истории в ключ не входит. Ответ живёт ttl
+    секунд; в RAM хранится не больше max_size ответов (LRU), при persist
+    они дублируются в SQLite и переживают перезапуск. Стили с "cache": False
+    кеш не используют.
+    """
+
+    def __init__(self, max_size: int, ttl: float, persist: bool):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = OrderedDict()  # key -> (ответ, сек на генерацию, когда истекает по time.time())
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0               # сек ожидания модели, сэкономленных попаданиями
+        self.stores = 0
+
+    async def key(self, chat_id: int, model_name: str, user_message: str, reply_context: str = None,
+                  memory_ids=()):
+        """
+        Ключ запроса или None, если кеш для этого чата не используется.
+
+        Args:
+            memory_ids: id воспоминаний, найденных для этого вопроса (recall_memories)
+        """
+        if not RESPONSE_CACHE:
+            return None
+        settings = await get_chat_settings(chat_id)
+        style = STYLE_PROMPTS.get(settings["style"], STYLE_PROMPTS[DEFAULT_STYLE])
+        if not style.get("cache", True):
+            return None
+
+        history = await get_memory(chat_id)
+        context = [
+            f"{msg.role}:{normalize_for_cache(msg.content)}"
+            for msg in history[-RESPONSE_CACHE_CONTEXT:]
+        ]
+        await prompt_cache.summaries(chat_id)
+        raw = json.dumps([
+            AVAILABLE_MODELS.get(model_name, model_name),
+            style["prompt"],
+            sorted(prompt_cache.summary_texts(chat_id)),
+            list(memory_ids),
+            context,
+            normalize_for_cache(user_message),
+            normalize_for_cache(reply_context or ""),
+        ], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None and self.persist:
+            row = await storage.read(_load_cached_response, key)
+            if row:
+                entry = tuple(row)
+                self._remember(key, entry)
+
+        if entry is None or entry[2] <= time.time():
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved += entry[1]
+        print(f"🗃️  Ответ из кеша (сэкономлено ~{entry[1]:.1f} с)")
+        return entry[0]
+
+    async def put(self, key: str, response: str, latency: float):
+        entry = (response, latency, time.time() + self.ttl)
+        self._remember(key, entry)
+        if self.persist:
+            self.stores += 1
+            await storage.write(_save_cached_response, key, *entry)
+            if self.stores % 100 == 0:
+                await storage.write(_purge_response_cache, RESPONSE_CACHE_DB_SIZE)
+
+    def describe(self) -> str:
+        """Строка для /stats"""
+        if not RESPONSE_CACHE:
+            return "выключен"
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"{rate:.0%} попаданий ({self.hits}/{total}), сэкономлено ~{self.saved:.0f} с"
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PERSIST)
+
+
+# -------------------------
+#       AI: ОТВЕТ БОТА
+# -------------------------
+
+def estimate_tokens(text: str) -> int:
+    """
+    Быстрая оценка числа токенов без токенизатора.
+
+    Около 4 байт UTF-8 на токен: латиница — ~4 символа на токен,
+    кириллица (2 байта на символ) — ~2 символа, что близко к BPE
+    токенизаторам популярных моделей. Плюс служебные токены сообщения.
+    """
+    return len(text.encode("utf-8")) // 4 + 4
+
+
+def pack_context(entries, budget: int):
+    """
+    Берёт сообщения с конца (самые новые), пока они помещаются в бюджет.
+
+    Args:
+        entries: пары (сообщение, оценка токенов)
+
+    Returns:
+        (выбранные сообщения в исходном порядке, потраченные токены)
+    """
+    packed = []
+    used = 0
+    for msg, cost in reversed(entries):
+        if used + cost > budget:
+            break
+        packed.append(msg)
+        used += cost
+    packed.reverse()
+    return packed, used
+
+
+def age_label(age: float) -> str:
+    """
+    Читаемая метка «когда отправлено» для сообщения истории.
+
+    После первых пяти минут минуты округляются вниз до 5, чтобы метка
+    менялась редко и отрендеренное сообщение переиспользовалось.
+    """
+    if age < 60:
+        return "только что"
+    if age < 3600:
+        minutes = int(age / 60)
+        if minutes >= 5:
+            minutes -= minutes % 5
+        return f"{minutes} мин назад"
+    if age < 86400:
+        return f"{int(age / 3600)} ч назад"
+    return f"{int(age / 86400)} дн назад"
+
+
+class ChatPrompt:
+    """Готовые части промпта одного чата"""
+
+    __slots__ = ("style", "system", "summaries", "summary_texts", "summaries_version", "history")
+
+    def __init__(self):
+        self.style = None
+        self.system = None           # (системное сообщение стиля, токены)
+        self.summaries = None        # [(сообщение со сводкой, токены)]; None — перечитать из БД
+        self.summary_texts = frozenset()  # тексты этих сводок, чтобы не дублировать их найденными
+        self.summaries_version = 0
+        self.history = {}            # MemoryRecord -> (метка времени, (сообщение, токены))
+
+
+class PromptCache:
+    """
+    Инкрементальная сборка промпта.
+
+    Системный промпт стиля и сообщения со сводками чата собираются один раз
+    и живут, пока не сменится стиль или не появится новая сводка
+    (invalidate_summaries). Сообщения истории рендерятся один раз на запись
+    памяти; при следующих запросах пересчитывается только метка времени,
+    и сообщение собирается заново, лишь когда метка изменилась. Оценки
+    токенов хранятся рядом с сообщениями. Готовые части держатся для
+    max_chats последних чатов (LRU).
+    """
+
+    def __init__(self, max_chats: int):
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> ChatPrompt
+        self.rendered = 0            # сообщений истории собрано заново
+        self.reused = 0              # сообщений истории взято готовыми
+
+    def _chat(self, chat_id: int) -> ChatPrompt:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatPrompt()
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return chat
+
+    def invalidate_summaries(self, chat_id: int):
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.summaries = None
+            chat.summaries_version += 1
+
+    async def prefix(self, chat_id: int, style_name: str):
+        """
+        Returns:
+            ((системное сообщение, токены), [(сообщение со сводкой, токены)])
+        """
+        chat = self._chat(chat_id)
+        if chat.style != style_name:
+            prompt = STYLE_PROMPTS.get(style_name, STYLE_PROMPTS[DEFAULT_STYLE])["prompt"]
+            chat.system = ({"role": "system", "content": prompt}, estimate_tokens(prompt))
+            chat.style = style_name
+
+        return chat.system, await self.summaries(chat_id)
+
+    async def summaries(self, chat_id: int):
+        """Сообщения со сводками чата: [(сообщение, токены)]"""
+        chat = self._chat(chat_id)
+        summaries = chat.summaries
+        if summaries is None:
+            version = chat.summaries_version
+            summaries = []
+            rows = await load_recent_summaries(chat_id)
+            for level, s in rows:
+                if level:
+                    content = f"Сводка давних разговоров в этом чате: {s}"
+                else:
+                    content = f"Краткая сводка прошлых разговоров в этом чате: {s}"
+                summaries.append(({"role": "system", "content": content}, estimate_tokens(content)))
+            # Если сводку сохранили, пока шло чтение, прочитанное могло устареть
+            if chat.summaries_version == version:
+                chat.summaries = summaries
+                chat.summary_texts = frozenset(s for _, s in rows)
+        return summaries
+
+    def summary_texts(self, chat_id: int):
+        """Тексты сводок, уже попавших в summaries()"""
+        return self._chat(chat_id).summary_texts
+
+    def history(self, chat_id: int, records, now: float):
+        """
+        Сообщения истории для промпта.
+
+        Метки времени добавляются ТОЛЬКО к сообщениям пользователей; ответы
+        бота (assistant) идут без меток, чтобы модель не копировала формат.
+
+        Returns:
+            [(сообщение, токены)] в порядке записей памяти
+        """
+        chat = self._chat(chat_id)
+        previous = chat.history
+        current = {}
+        for record in records:
+            label = age_label(now - record.ts) if record.role == "user" else None
+            entry = previous.get(record)
+            if entry is None or entry[0] != label:
+                content = f"[{label}] {record.content}" if label else record.content
+                entry = (label, ({"role": record.role, "content": content}, estimate_tokens(content)))
+                self.rendered += 1
+            else:
+                self.reused += 1
+            current[record] = entry
+        # Записи, ушедшие из памяти, отпадают вместе со старым словарём
+        chat.history = current
+        return [entry[1] for entry in current.values()]
+
+
+prompt_cache = PromptCache(PROMPT_CACHE_CHATS)
+
+
+@traced("memory_search")
+async def recall_memories(chat_id: int, user_message: str, reply_context: str = None):
+    """
+    Записи долгосрочной памяти, похожие на вопрос, в виде сообщений промпта.
+
+    Сводки, которые и так идут в промпт из prompt_cache, пропускаются.
+
+    Returns:
+        (id записей, [(сообщение, токены)]) по возрастанию сходства — самое
+        похожее в конце, чтобы pack_context при нехватке бюджета отбросил менее похожие
+    """
+    query = f"{reply_context}\n{user_message}" if reply_context else user_message
+    await prompt_cache.summaries(chat_id)
+    known = prompt_cache.summary_texts(chat_id)
+    ids = []
+    entries = []
+    for row_id, kind, content, ts, _ in reversed(await memory_index.search(chat_id, query)):
+        if content in known:
+            continue
+        label = "сводка" if kind == "summary" else "сообщение"
+        date = datetime.fromtimestamp(ts, timezone.utc).strftime("%d.%m.%Y")
+        text = f"Из долгосрочной памяти чата ({label} от {date}): {content}"
+        ids.append(row_id)
+        entries.append(({"role": "system", "content": text}, estimate_tokens(text)))
+    return ids, entries
+
+
+@traced("build_prompt")
+async def build_ai_request(user_message: str, chat_id: int, reply_context: str, model_name: str,
+                           recalled=None):
+    """
+    Собирает тело запроса к OpenRouter: стиль, сводки, воспоминания, история и сообщение пользователя.
+
+    Промпт укладывается в бюджет модели из MODEL_PROMPT_BUDGETS: системный
+    промпт и сообщение пользователя идут всегда, дальше самые новые сообщения
+    истории, а под сводки и найденные по вопросу воспоминания (они заменяют
+    более старые сообщения) история оставляет до SUMMARY_BUDGET_SHARE
+    бюджета. Готовые части берутся из prompt_cache.
+
+    Args:
+        recalled: результат recall_memories для этого вопроса — ищется один раз
+                  на запрос, а не заново для каждой модели fallback; None — искать здесь
+
+    Returns:
+        (тело запроса, оценка числа токенов промпта)
+    """
+    # Получаем настройки чата и полное имя модели
+    with tracer.span("settings"):
+        settings = await get_chat_settings(chat_id)
+    model_full = AVAILABLE_MODELS.get(model_name, AVAILABLE_MODELS[DEFAULT_MODEL])
+
+    with tracer.span("prompt_prefix"):
+        (system_message, system_cost), summary_entries = await prompt_cache.prefix(chat_id, settings["style"])
+    with tracer.span("get_memory"):
+        history = await get_memory(chat_id)
+    history_entries = prompt_cache.history(chat_id, history, time.time())
+    if recalled is None:
+        recalled = await recall_memories(chat_id, user_message, reply_context)
+    _, memory_entries = recalled
+    summary_entries = summary_entries + memory_entries
+
+    # Если есть контекст из реплая, добавляем его в сообщение
+    if reply_context:
+        user_message = f"[Отвечая на: {reply_context}]\n{user_message}"
+
+    # Укладываемся в бюджет модели
+    budget = MODEL_PROMPT_BUDGETS.get(model_name, DEFAULT_PROMPT_BUDGET)
+    remaining = budget - system_cost - estimate_tokens(user_message)
+
+    summaries_cost = sum(cost for _, cost in summary_entries)
+    reserved = min(summaries_cost, int(max(remaining, 0) * SUMMARY_BUDGET_SHARE))
+
+    packed_history, history_used = pack_context(history_entries, remaining - reserved)
+    packed_summaries, summaries_used = pack_context(summary_entries, remaining - history_used)
+
+    prompt_tokens = budget - remaining + history_used + summaries_used
+    tracer.annotate(model=model_name, prompt_tokens=prompt_tokens, history=len(packed_history),
+                    summaries=len(packed_summaries), memories=len(memory_entries))
+    print(
+        f"📏 Промпт для {model_name}: ~{prompt_tokens} токенов из {budget} "
+        f"(история {len(packed_history)}/{len(history_entries)}, "
+        f"сводки и воспоминания {len(packed_summaries)}/{len(summary_entries)})"
+    )
+
+    body = {
+        "model": model_full,
+        "messages": [
+            system_message,
+            *packed_summaries,
+            *packed_history,
+            {"role": "user", "content": user_message}
+        ]
+    }
+    return body, prompt_tokens
+
+
+@traced("ask_ai")
+async def ask_ai(user_message: str, chat_id: int, reply_context: str = None, model_override: str = None,
+                 recalled=None):
+    """
+    Отправляет запрос к AI модели.
+
+    Args:
+        user_message: Сообщение пользователя
+        chat_id: ID чата
+        reply_context: Контекст из реплая (опционально)
+        model_override: Принудительная модель (для fallback)
+        recalled: Найденные воспоминания (recall_memories), если уже искали
+    """
+    if model_override:
+        model_name = model_override  # Используем override если указан
+    else:
+        model_name = (await get_chat_settings(chat_id))["model"]
+
+    body, prompt_tokens = await build_ai_request(user_message, chat_id, reply_context, model_name, recalled)
+
+    started = time.monotonic()
+    response = await openrouter.post(body)
+    print("FULL RESPONSE:", response.text)
+    data = response.json()
+
+    # Фактический размер промпта от провайдера (если есть) рядом с оценкой и временем ответа
+    usage = data.get("usage") or {}
+    print(
+        f"⏱️  {model_name}: {time.monotonic() - started:.1f} с, промпт ~{prompt_tokens} токенов"
+        f" (по данным провайдера: {usage.get('prompt_tokens', '—')})"
+    )
+
+    if "choices" not in data:
+        # Возвращаем ошибку с информацией о модели для fallback
+        return {"error": data, "model": model_name, "retry_after": response.headers.get("Retry-After")}
+
+    return {"response": data["choices"][0]["message"]["content"], "model": model_name}
 
 
-def get_memory(chat_id):
-    """Возвращает краткосрочную память чата (автозагрузка из БД при первом обращении)"""
-    # Если память для чата пустая, загружаем из БД
-    if chat_id not in memory_buffer or len(memory_buffer[chat_id]) == 0:
-        memory_buffer[chat_id] = load_messages_from_db(chat_id, limit=MAX_MEMORY)
+def _p90(samples) -> float:
+    """p90 окна задержек; None, пока замеров меньше пяти"""
+    samples = sorted(samples)
+    if len(samples) < 5:
+        return None
+    return samples[int(0.9 * (len(samples) - 1))]
 
-    return memory_buffer.get(chat_id, [])
 
+def hedge_delay(model_name: str) -> float:
+    """Через сколько секунд без ответа запускать следующую модель (p90 недавних ответов)"""
+    health = model_health.get(model_name)
+    p90 = _p90(health.latencies) if health else None
+    if p90 is None:
+        return HEDGE_DELAY_DEFAULT
+    return max(HEDGE_DELAY_MIN, p90)
 
-# -------------------------
-#        ИНИЦИАЛИЗАЦИЯ
-# -------------------------
 
-load_dotenv()
+def first_token_delay(model_name: str) -> float:
+    """
+    Сколько ждать первый кусок потока, прежде чем уходить на fallback (p90 недавних TTFB).
 
-TOKEN = os.getenv("TELEGRAM_TOKEN")
-OPENROUTER_KEY = os.getenv("OPENROUTER_KEY")
+    Пока потоков мало, берём hedge_delay: полный ответ не приходит раньше первого куска.
+    """
+    health = model_health.get(model_name)
+    p90 = _p90(health.first_tokens) if health else None
+    if p90 is None:
+        return hedge_delay(model_name)
+    return max(HEDGE_DELAY_MIN, p90)
 
-# Проверка наличия обязательных переменных окружения
-if not TOKEN:
-    raise ValueError(
-        "❌ TELEGRAM_TOKEN не найден!\n"
-        "Установите переменную окружения TELEGRAM_TOKEN в Railway Dashboard (Settings → Variables)"
-    )
-if not OPENROUTER_KEY:
-    raise ValueError(
-        "❌ OPENROUTER_KEY не найден!\n"
-        "Установите переменную окружения OPENROUTER_KEY в Railway Dashboard (Settings → Variables)"
-    )
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+@traced("try_model")
+async def try_model(user_message: str, chat_id: int, reply_context: str, model_name: str, recalled=None):
+    """
+    Один запрос к модели для fallback.
 
+    Returns:
+        (текст ответа, None) при успехе или (None, описание ошибки)
 
-# -------------------------
-#   AI: SUMMARY ДЛЯ ПАМЯТИ
-# -------------------------
+    Исключения, не относящиеся к OpenRouter (см. MODEL_ERRORS), пробрасываются.
+    """
+    tracer.annotate(model=model_name)
+    health = model_health[model_name]
+    started = time.monotonic()
+    try:
+        print(f"🔄 Пробую модель: {model_name}")
+        result = await ask_ai(user_message, chat_id, reply_context, model_override=model_name, recalled=recalled)
+    except MODEL_ERRORS as e:
+        print(f"❌ Исключение при запросе к {model_name}: {e}")
+        health.record_failure()
+        return None, {"exception": str(e)}
+
+    # Проверяем на ошибку
+    if isinstance(result, dict) and "error" in result:
+        error_data = result["error"]
+
+        # Проверяем код ошибки
+        if "error" in error_data and isinstance(error_data["error"], dict):
+            error_code = error_data["error"].get("code")
+            error_msg = error_data["error"].get("message", "")
+
+            # Rate limit или provider error - отключаем модель и пробуем следующую
+            if error_code in [429, 502, 503] or "rate-limited" in error_msg.lower():
+                print(f"⚠️  Модель {model_name} недоступна (код {error_code}), пробую следующую...")
+                health.record_failure(parse_retry_after(error_data, result.get("retry_after")), hard=True)
+                return None, error_data
+
+        # Другая ошибка - тоже пробуем следующую
+        print(f"⚠️  Ошибка модели {model_name}, пробую следующую...")
+        health.record_failure()
+        return None, error_data
+
+    # Успех!
+    if isinstance(result, dict) and "response" in result:
+        health.record_success(time.monotonic() - started)
+        return result["response"], None
+
+    # Неожиданный формат ответа
+    health.record_failure()
+    return None, {"unexpected_format": result}
+
+
+@traced("ask_ai_with_fallback")
+async def ask_ai_with_fallback(user_message: str, chat_id: int, reply_context: str = None, exclude=(),
+                               recalled=None):
+    """
+    Отправляет запрос к AI с автоматическим fallback между моделями при ошибках.
 
-async def summarize_chat(chat_id: int):
-    """Делает краткое summary из переписки и сохраняет в БД"""
-    history = get_memory(chat_id)
-    if not history:
-        return
+    Порядок моделей выбирается по их здоровью (см. order_models): отключённые
+    circuit breaker модели пропускаются, предпочитаемая идёт первой, если жива.
+    Режим (настройка чата fallback_mode):
+        sequential — следующая модель только после ошибки предыдущей
+        hedged     — следующая модель также стартует, если текущая молчит дольше
+                     p90 своих недавних ответов
+        race-all   — все модели сразу
+    Побеждает первый успешный ответ, остальные запросы отменяются.
+    Модели из exclude не пробуются (например, только что упавшая при стриминге).
+    Воспоминания по вопросу ищутся один раз (или приходят готовыми в recalled)
+    и идут во все попытки.
+    Ответ предпочитаемой модели кладётся в response_cache, а повторный такой же
+    запрос отвечается оттуда без обращения к OpenRouter.
+    """
+    # Получаем предпочитаемую модель из настроек
+    settings = await get_chat_settings(chat_id)
+    preferred_model = settings["model"]
+    mode = settings["fallback_mode"]
+
+    tracer.annotate(mode=mode, preferred=preferred_model)
+
+    # С exclude это дозапрос после упавшего стриминга — кеш там уже проверен
+    if recalled is None:
+        recalled = await recall_memories(chat_id, user_message, reply_context)
+    cache_key = None
+    if not exclude:
+        cache_key = await response_cache.key(chat_id, preferred_model, user_message, reply_context, recalled[0])
+    if cache_key:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            tracer.annotate(cached=True)
+            return cached
+    started = time.monotonic()
+
+    # Порядок попыток: по здоровью моделей
+    queue = [model for model in order_models(preferred_model) if model not in exclude]
+    if not queue:
+        queue = order_models(preferred_model)
+    running = {}  # task -> model_name
+    launched = 0
+    last_error = None
 
-    # Берём всё, кроме хвоста, чтобы хвост оставить для живого контекста
-    if len(history) <= TAIL_AFTER_SUMMARY:
-        return
+    def launch_next():
+        nonlocal launched
+        launched += 1
+        model_name = queue.pop(0)
+        task = asyncio.create_task(try_model(user_message, chat_id, reply_context, model_name, recalled))
+        running[task] = model_name
+        return model_name
 
-    to_summarize = history[:-TAIL_AFTER_SUMMARY]
-    tail = history[-TAIL_AFTER_SUMMARY:]
+    for _ in range(len(queue) if mode == "race-all" else 1):
+        launch_next()
 
-    # Собираем текст истории для свёртки
-    conversation_text = "\n".join(
-        f"{m['role']}: {m['content']}" for m in to_summarize
-    )
+    try:
+        while running:
+            # В режиме hedged ждём ответа не дольше бюджета последней запущенной модели
+            timeout = None
+            if mode == "hedged" and queue:
+                timeout = hedge_delay(list(running.values())[-1])
 
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json"
-    }
-    body = {
-        "model": "deepseek/deepseek-chat:free",
-        "messages": [
-            {
-                "role": "system",
-                "content": (
-                    "Ты делаешь очень краткую сводку переписки в чате. "
-                    "Сжато опиши, что обсуждали, кто с кем спорил, какие важные факты и решения были. "
-                    "Пиши 3–6 коротких предложений, без лишних деталей."
-                )
-            },
-            {
-                "role": "user",
-                "content": conversation_text
-            }
-        ]
-    }
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, headers=headers, json=body)
-        print("SUMMARY RESPONSE:", resp.text)
-        data = resp.json()
-        if "choices" not in data:
-            return
-        summary = data["choices"][0]["message"]["content"]
+            if not done:
+                print(f"⏱️  Нет ответа за {timeout:.1f} с, параллельно запускаю {launch_next()}")
+                continue
 
-    # сохраняем summary в БД
-    save_summary(chat_id, summary)
+            for task in done:
+                model_name = running.pop(task)
+                response_text, error = task.result()
+
+                if response_text is not None:
+                    # Логируем если использовали fallback
+                    if model_name != preferred_model:
+                        print(f"✅ Ответ получен от резервной модели: {model_name}")
+                    elif cache_key:
+                        await response_cache.put(cache_key, response_text, time.monotonic() - started)
+                    fallback_requests.inc(str(launched - 1), "ok")
+                    tracer.annotate(model=model_name, hops=launched - 1)
+                    return response_text
+
+                last_error = error
+
+            # Ошибка — сразу пробуем следующую модель, если другие уже не в работе
+            if queue and (mode == "hedged" or not running):
+                launch_next()
+    finally:
+        # Отменяем проигравшие запросы
+        for task in running:
+            task.cancel()
 
-    # в краткосрочной памяти оставляем только хвост
-    memory_buffer[chat_id] = tail
+    # Все модели не сработали
+    fallback_requests.inc(str(launched - 1), "failed")
+    tracer.annotate(hops=launched - 1, failed=True)
+    print(f"❌ Все модели недоступны. Последняя ошибка: {last_error}")
+    return f"⚠️ Все AI модели временно недоступны. Пожалуйста, попробуйте позже.\n\nПоследняя ошибка: {last_error}"
 
 
 # -------------------------
-#  СОХРАНЕНИЕ ПАМЯТИ ПРИ ЗАВЕРШЕНИИ
+#   AI: ПОТОКОВЫЙ ОТВЕТ
 # -------------------------
 
-async def save_all_memories():
+async def edit_stream_message(sent: Message, text: str, final: bool = False):
     """
-    Сохраняет всю краткосрочную память в summary перед завершением бота.
-    Вызывается при получении сигнала остановки (SIGTERM/SIGINT).
+    Обновляет сообщение с ответом.
+
+    Промежуточные правки при нехватке лимита просто пропускаются — следующая
+    всё равно покажет свежий текст; финальная идёт с приоритетом ответа.
     """
-    print("🛑 Получен сигнал остановки. Сохраняю память всех чатов...")
+    try:
+        if final:
+            await outbox.edit(sent, text, priority=PRIORITY_REPLY)
+        else:
+            await outbox.edit(sent, text, droppable=True)
+    except TelegramBadRequest:
+        # "message is not modified" и подобное — обновлять нечего
+        return
 
-    # Проходим по всем чатам с активной памятью
-    for chat_id in list(memory_buffer.keys()):
-        history = memory_buffer.get(chat_id, [])
 
-        if not history or len(history) < 2:  # Пропускаем если слишком мало сообщений
-            continue
+@traced("stream_reply")
+async def stream_ai_reply(message: Message, user_message: str, chat_id: int, reply_context: str = None,
+                          as_reply: bool = False) -> str:
+    """
+    Отвечает потоково: сразу отправляет заглушку и правит её по мере генерации.
 
-        print(f"💾 Сохраняю {len(history)} сообщений для чата {chat_id}")
+    Правки идут не чаще STREAM_EDIT_INTERVAL (в группах — STREAM_EDIT_INTERVAL_GROUP),
+    чтобы не упираться в лимиты Telegram на редактирование. Если поток падает
+    до или посреди ответа, молчит дольше STREAM_FIRST_TOKEN_TIMEOUT до первого
+    куска или не укладывается в STREAM_TOTAL_TIMEOUT, ответ добирается обычным
+    ask_ai_with_fallback без этой модели и заменяет частичный текст. Прочие
+    исключения (не из MODEL_ERRORS) модели в ошибку не засчитываются и пробрасываются.
 
-        try:
-            # Создаём summary из всей истории (без деления на хвост)
-            conversation_text = "\n".join(
-                f"{m['role']}: {m['content']}" for m in history
-            )
+    Режим fallback чата учитывается так же, как в ask_ai_with_fallback: в hedged
+    первый кусок ждём не дольше обычного для модели (first_token_delay), а
+    race-all стримить нечем — гонка идёт целиком через ask_ai_with_fallback.
 
-            url = "https://openrouter.ai/api/v1/chat/completions"
-            headers = {
-                "Authorization": f"Bearer {OPENROUTER_KEY}",
-                "Content-Type": "application/json"
-            }
-            body = {
-                "model": "deepseek/deepseek-chat:free",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": (
-                            "Ты делаешь краткую сводку переписки перед завершением сессии. "
-                            "Сжато опиши основные темы, важные факты и решения. "
-                            "3–5 коротких предложений."
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": conversation_text
-                    }
-                ]
-            }
+    Returns:
+        Итоговый текст ответа (для записи в память)
+    """
+    send = partial(outbox.reply if as_reply else outbox.answer, message)
+    edit_interval = STREAM_EDIT_INTERVAL_GROUP if as_reply else STREAM_EDIT_INTERVAL
+
+    settings = await get_chat_settings(chat_id)
+    if settings["fallback_mode"] == "race-all":
+        text = await ask_ai_with_fallback(user_message, chat_id, reply_context)
+        await send(text)
+        return text
+
+    # Ответ из кеша отправляем сразу целиком, без заглушки
+    recalled = await recall_memories(chat_id, user_message, reply_context)
+    cache_key = await response_cache.key(chat_id, settings["model"], user_message, reply_context, recalled[0])
+    if cache_key:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            await send(cached)
+            return cached
+
+    sent = await send("✍️ ...")
+
+    model_name = order_models(settings["model"])[0]
+    health = model_health[model_name]
+    first_token_timeout = STREAM_FIRST_TOKEN_TIMEOUT
+    if settings["fallback_mode"] == "hedged":
+        first_token_timeout = min(first_token_timeout, first_token_delay(model_name))
+
+    text = ""
+    shown = ""
+    last_edit = time.monotonic()
+    started = last_edit
+    ttfb = None
 
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.post(url, headers=headers, json=body)
-                data = resp.json()
+    try:
+        print(f"🔄 Стриминг от модели: {model_name}")
+        body, _ = await build_ai_request(user_message, chat_id, reply_context, model_name, recalled)
+
+        loop = asyncio.get_running_loop()
+        stream_started = loop.time()
+        with tracer.span("openrouter_stream", model=model_name) as span:
+            # Сначала ждём первый кусок не дольше first_token_timeout, потом — весь ответ
+            async with asyncio.timeout_at(stream_started + first_token_timeout) as timeout:
+                async for delta in openrouter.stream(body):
+                    if not text:
+                        ttfb = loop.time() - stream_started
+                        span.set(ttfb_ms=round(ttfb * 1000, 1))
+                        timeout.reschedule(stream_started + STREAM_TOTAL_TIMEOUT)
+                    text += delta
+                    now = time.monotonic()
+                    if now - last_edit >= edit_interval and len(text) <= TELEGRAM_MESSAGE_LIMIT - 2:
+                        shown = text + " ▌"
+                        await edit_stream_message(sent, shown)
+                        last_edit = now
+
+        if not text.strip():
+            raise OpenRouterError({"error": {"message": "пустой ответ"}})
+
+        health.record_success(time.monotonic() - started, first_token=ttfb)
+        if cache_key and model_name == settings["model"]:
+            await response_cache.put(cache_key, text, time.monotonic() - started)
+
+    except OpenRouterError as e:
+        error = e.data.get("error") if isinstance(e.data, dict) else None
+        error_code = error.get("code") if isinstance(error, dict) else None
+        print(f"⚠️  Стриминг от {model_name} прервался (код {error_code}), переключаюсь на fallback...")
+        health.record_failure(parse_retry_after(e.data, e.retry_after), hard=error_code in [429, 502, 503])
+        text = await ask_ai_with_fallback(user_message, chat_id, reply_context, exclude=(model_name,),
+                                          recalled=recalled)
+
+    except TimeoutError:
+        if text:
+            print(f"⏱️  Стриминг от {model_name} дольше {STREAM_TOTAL_TIMEOUT:.0f} с, переключаюсь на fallback...")
+        else:
+            print(f"⏱️  Нет ответа от {model_name} за {first_token_timeout:.1f} с, переключаюсь на fallback...")
+        health.record_failure()
+        text = await ask_ai_with_fallback(user_message, chat_id, reply_context, exclude=(model_name,),
+                                          recalled=recalled)
 
-                if "choices" in data:
-                    summary = data["choices"][0]["message"]["content"]
-                    save_summary(chat_id, summary)
-                    print(f"✅ Память чата {chat_id} сохранена")
-                else:
-                    print(f"⚠️  Не удалось создать summary для чата {chat_id}")
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        print(f"❌ Исключение при стриминге от {model_name}: {e}")
+        health.record_failure()
+        text = await ask_ai_with_fallback(user_message, chat_id, reply_context, exclude=(model_name,),
+                                          recalled=recalled)
 
-        except Exception as e:
-            print(f"❌ Ошибка при сохранении чата {chat_id}: {e}")
+    # Финальный текст: первая часть — в заглушку, остальное (если длиннее лимита) — новыми сообщениями
+    parts = split_message(text)
+    if parts[0] != shown:
+        await edit_stream_message(sent, parts[0], final=True)
+    for part in parts[1:]:
+        await send(part)
 
-    print("✅ Все чаты сохранены. Завершаю работу...")
+    return text
 
 
 # -------------------------
-#       AI: ОТВЕТ БОТА
+#   AI: СКЛЕЙКА УПОМИНАНИЙ
 # -------------------------
 
-async def ask_ai(user_message: str, chat_id: int, reply_context: str = None, model_override: str = None):
-    """
-    Отправляет запрос к AI модели.
-
-    Args:
-        user_message: Сообщение пользователя
-        chat_id: ID чата
-        reply_context: Контекст из реплая (опционально)
-        model_override: Принудительная модель (для fallback)
-    """
-    url = "https://openrouter.ai/api/v1/chat/completions"
-
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json",
-        "Referer": "https://github.com/Urma1/GhostAI",
-        "X-Title": "GhostAI Bot"
-    }
+async def answer_in_group(message: Message, user_message: str, chat_id: int, reply_context: str = None):
+    """Отвечает реплаем на сообщение в группе и записывает ответ в память"""
+    with tracer.span("reply", stream=STREAM_REPLIES):
+        if STREAM_REPLIES:
+            reply = await stream_ai_reply(message, user_message, chat_id, reply_context, as_reply=True)
+        else:
+            reply = await ask_ai_with_fallback(user_message, chat_id, reply_context)
+            await outbox.reply(message, reply)
 
-    # Получаем настройки чата
-    settings = get_chat_settings(chat_id)
-    model_name = model_override or settings["model"]  # Используем override если указан
-    style_name = settings["style"]
+    with tracer.span("add_to_memory"):
+        await add_to_memory(chat_id, "assistant", f"Бот: {reply}", datetime.now(timezone.utc))
 
-    # Получаем полное имя модели и системный промпт
-    model_full = AVAILABLE_MODELS.get(model_name, AVAILABLE_MODELS[DEFAULT_MODEL])
-    system_prompt = STYLE_PROMPTS.get(style_name, STYLE_PROMPTS[DEFAULT_STYLE])["prompt"]
+    # если память большая — делаем summary в фоне
+    if len(await get_memory(chat_id)) > MAX_MEMORY:
+        summary_queue.schedule(chat_id)
 
-    history = get_memory(chat_id)
-    summaries = load_recent_summaries(chat_id)
 
-    summary_messages = [
-        {
-            "role": "system",
-            "content": f"Краткая сводка прошлых разговоров в этом чате: {s}"
-        }
-        for s in summaries
+def merge_mentions(mentions) -> str:
+    """Собирает несколько обращений к боту в один запрос"""
+    lines = [
+        "Тебе почти одновременно написали несколько человек. "
+        "Ответь всем одним сообщением, обращаясь к каждому по имени:"
     ]
+    for _, username, text, reply_context in mentions:
+        line = f"- {username}: {text}"
+        if reply_context:
+            line += f" (в ответ на: «{reply_context}»)"
+        lines.append(line)
+    return "\n".join(lines)
 
-    # Форматируем историю с временными метками
-    history_messages = []
-    now = datetime.now(timezone.utc)
-
-    for msg in history:
-        # Добавляем временные метки ТОЛЬКО к сообщениям пользователей
-        # Ответы бота (assistant) идут без меток, чтобы не копировать формат
-        if msg["role"] == "user":
-            timestamp = msg.get("timestamp", now)
-            # Вычисляем разницу во времени
-            time_diff = now - timestamp
-
-            # Форматируем время в читаемый вид
-            if time_diff.total_seconds() < 60:
-                time_str = "только что"
-            elif time_diff.total_seconds() < 3600:
-                minutes = int(time_diff.total_seconds() / 60)
-                time_str = f"{minutes} мин назад"
-            elif time_diff.total_seconds() < 86400:
-                hours = int(time_diff.total_seconds() / 3600)
-                time_str = f"{hours} ч назад"
-            else:
-                days = int(time_diff.total_seconds() / 86400)
-                time_str = f"{days} дн назад"
-
-            content_with_time = f"[{time_str}] {msg['content']}"
-            history_messages.append({
-                "role": msg["role"],
-                "content": content_with_time
-            })
-        else:
-            # Для ответов бота - без временных меток
-            history_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
 
-    # Если есть контекст из реплая, добавляем его в сообщение
-    if reply_context:
-        user_message = f"[Отвечая на: {reply_context}]\n{user_message}"
+class MentionCoalescer:
+    """
+    Склейка упоминаний бота в группе в один запрос к AI.
+
+    Первое упоминание открывает окно: фоновая задача чата ждёт window сек
+    и отвечает на всё, что успело накопиться. Упоминания, пришедшие, пока
+    ответ генерируется, не ждут своей очереди по одному, а уходят следующим
+    общим запросом сразу после текущего. Обработчик апдейта только кладёт
+    упоминание в пачку и возвращается, поэтому очередь чата в update_scheduler
+    не стоит и следующие сообщения успевают попасть в ту же пачку. Сам ответ
+    ставится в ту же очередь чата (update_scheduler.run), так что он идёт по
+    порядку с остальными апдейтами чата и под её ограничениями; пачка
+    забирается, когда до ответа дошла очередь.
+    """
 
-    body = {
-        "model": model_full,
-        "messages": [
-            {
-                "role": "system",
-                "content": system_prompt
-            },
-            *summary_messages,
-            *history_messages,
-            {"role": "user", "content": user_message}
-        ]
-    }
+    def __init__(self, max_mentions: int):
+        self.max_mentions = max_mentions
+        self._pending = {}                 # chat_id -> [(message, username, text, reply_context)]
+        self._tasks = {}                   # chat_id -> задача, отвечающая на упоминания чата
+        self.mentions = 0
+        self.requests = 0
+
+    def submit(self, message: Message, username: str, text: str, reply_context: str, window: float):
+        chat_id = message.chat.id
+        self._pending.setdefault(chat_id, []).append((message, username, text, reply_context))
+        self.mentions += 1
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._run(chat_id, window))
+
+    async def _run(self, chat_id: int, window: float):
+        # Задача создана внутри трейса первого упоминания; у пачек — свои трейсы
+        current_span.set(None)
+        try:
+            await asyncio.sleep(window)
+            while self._pending.get(chat_id):
+                answered = asyncio.get_running_loop().create_future()
+                if not await update_scheduler.run(chat_id, self._answer, chat_id, answered):
+                    print(f"⚠️  Очередь чата {chat_id} переполнена, упоминания без ответа")
+                    break
+                await answered
+        finally:
+            self._pending.pop(chat_id, None)
+            del self._tasks[chat_id]
+
+    def busy(self) -> bool:
+        """Есть упоминания, на которые ещё не ответили"""
+        return bool(self._tasks)
+
+    async def _answer(self, chat_id: int, answered: asyncio.Future):
+        """Отвечает на накопившуюся пачку (выполняется в очереди чата)"""
+        try:
+            batch = self._pending.get(chat_id, [])[:self.max_mentions]
+            if not batch:
+                return
+            del self._pending[chat_id][:self.max_mentions]
+            self.requests += 1
+
+            message, _, text, reply_context = batch[-1]
+            if len(batch) > 1:
+                print(f"🧩 Склеено {len(batch)} упоминаний в чате {chat_id}")
+                text, reply_context = merge_mentions(batch), None
+            try:
+                with tracer.span("mentions", root=True, chat_id=chat_id, mentions=len(batch)):
+                    await answer_in_group(message, text, chat_id, reply_context)
+            except Exception as e:
+                print(f"❌ Ошибка ответа на упоминания в чате {chat_id}: {e}")
+        finally:
+            if not answered.done():
+                answered.set_result(None)
+
+    async def stop(self, timeout: float):
+        """Даёт дописать ответы на уже принятые упоминания (не дольше timeout)"""
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            print(f"⚠️  Не успели ответить на упоминания в {len(pending)} чатах")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=body)
-        print("FULL RESPONSE:", response.text)
-        data = response.json()
 
-        if "choices" not in data:
-            # Возвращаем ошибку с информацией о модели для fallback
-            return {"error": data, "model": model_name}
+mention_coalescer = MentionCoalescer(COALESCE_MAX_MENTIONS)
 
-        return {"response": data["choices"][0]["message"]["content"], "model": model_name}
 
+# -------------------------
+#   ПЛАНИРОВЩИК АПДЕЙТОВ
+# -------------------------
 
-async def ask_ai_with_fallback(user_message: str, chat_id: int, reply_context: str = None):
+class ChatScheduler:
     """
-    Отправляет запрос к AI с автоматическим fallback между моделями при ошибках.
-
-    Порядок моделей: deepseek → mistral → nova
+    Обработка апдейтов: по порядку внутри чата, параллельно между чатами.
+
+    У каждого активного чата своя очередь задач. Чат с работой стоит
+    в общей очереди готовых; workers фоновых задач берут из неё чат,
+    выполняют одну его задачу и, если в чате есть ещё, ставят его в конец.
+    Так два сообщения одного чата не обрабатываются одновременно, медленный
+    ответ в одном чате не задерживает другие, а чаты обслуживаются по кругу.
+
+    run() только ставит задачу в очередь чата и не ждёт её выполнения,
+    поэтому пачка апдейтов одного чата не занимает вызывающих (воркеры
+    вебхука, задачи поллинга) и не задерживает другие чаты. Ошибки задач
+    печатает сам worker. Больше chat_limit задач на чат — новые
+    отбрасываются (кроме помеченных droppable=False — апдейтов, на которые
+    бот не отвечает: их стоимость — запись в память, а потерять её нельзя);
+    больше max_pending задач всего — run() ждёт, пока освободится место.
     """
-    # Получаем предпочитаемую модель из настроек
-    settings = get_chat_settings(chat_id)
-    preferred_model = settings["model"]
 
-    # Порядок попыток: сначала предпочитаемая, потом остальные
-    models_order = [preferred_model]
-    for model in ["deepseek", "mistral", "nova"]:
-        if model != preferred_model:
-            models_order.append(model)
+    def __init__(self, workers: int, chat_limit: int, max_pending: int):
+        self.workers = workers
+        self.chat_limit = chat_limit
+        self._chats = {}                   # chat_id -> deque задач (первая — в работе)
+        self._ready = asyncio.Queue()      # чаты, у которых есть работа
+        self._slots = asyncio.Semaphore(max_pending)
+        self._tasks = []
+        self.pending = 0
+        self.dropped = 0
+        self.wait_ewma = 0.0               # сек от постановки в очередь до начала обработки
+        self.wait_max = 0.0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def chat_depth(self, chat_id: int) -> int:
+        """Сколько задач чата ждёт (не считая выполняемой)"""
+        jobs = self._chats.get(chat_id)
+        return len(jobs) - 1 if jobs else 0
+
+    async def run(self, chat_id: int, fn, *args, droppable: bool = True) -> bool:
+        """Ставит fn(*args) в очередь чата (не дожидаясь выполнения); False — очередь переполнена"""
+        self.start()
+
+        jobs = self._chats.get(chat_id)
+        if droppable and jobs is not None and len(jobs) > self.chat_limit:
+            self.dropped += 1
+            print(f"⚠️  Очередь чата {chat_id} переполнена, апдейт отброшен")
+            return False
+
+        await self._slots.acquire()
+        self.pending += 1
+
+        # Пока ждали места, чат мог освободиться и исчезнуть из _chats
+        jobs = self._chats.get(chat_id)
+        if jobs is None:
+            jobs = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+
+        jobs.append((fn, args, time.monotonic()))
+        return True
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._chats[chat_id]
+            fn, args, queued_at = jobs[0]
+
+            wait = time.monotonic() - queued_at
+            self.wait_ewma += 0.1 * (wait - self.wait_ewma)
+            self.wait_max = max(self.wait_max, wait)
 
-    last_error = None
+            try:
+                await fn(*args)
+            except Exception as e:
+                print(f"❌ Ошибка обработки апдейта в чате {chat_id}: {e}")
+            finally:
+                jobs.popleft()
+                self.pending -= 1
+                self._slots.release()
+                if jobs:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chats[chat_id]
 
-    for model_name in models_order:
-        try:
-            print(f"🔄 Пробую модель: {model_name}")
-            result = await ask_ai(user_message, chat_id, reply_context, model_override=model_name)
-
-            # Проверяем на ошибку
-            if isinstance(result, dict) and "error" in result:
-                error_data = result["error"]
-
-                # Проверяем код ошибки
-                if "error" in error_data and isinstance(error_data["error"], dict):
-                    error_code = error_data["error"].get("code")
-                    error_msg = error_data["error"].get("message", "")
-
-                    # Rate limit или provider error - пробуем следующую модель
-                    if error_code in [429, 502, 503] or "rate-limited" in error_msg.lower():
-                        print(f"⚠️  Модель {model_name} недоступна (код {error_code}), пробую следующую...")
-                        last_error = error_data
-                        continue
-
-                # Другая ошибка - тоже пробуем следующую
-                print(f"⚠️  Ошибка модели {model_name}, пробую следующую...")
-                last_error = error_data
-                continue
+    async def stop(self, timeout: float):
+        """Даёт дообработать очередь (не дольше timeout) и останавливает workers"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            print(f"⚠️  Не успели обработать {self.pending} апдейтов")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
 
-            # Успех!
-            if isinstance(result, dict) and "response" in result:
-                response_text = result["response"]
-                used_model = result["model"]
 
-                # Логируем если использовали fallback
-                if used_model != preferred_model:
-                    print(f"✅ Ответ получен от резервной модели: {used_model}")
+update_scheduler = ChatScheduler(
+    workers=SCHEDULER_WORKERS,
+    chat_limit=SCHEDULER_CHAT_LIMIT,
+    max_pending=SCHEDULER_MAX_PENDING,
+)
 
-                return response_text
 
-            # Неожиданный формат ответа
-            last_error = {"unexpected_format": result}
-            continue
+class ChatOrderMiddleware(BaseMiddleware):
+    """
+    Пропускает апдейты через update_scheduler по chat_id (апдейты без чата — напрямую).
 
-        except Exception as e:
-            print(f"❌ Исключение при запросе к {model_name}: {e}")
-            last_error = {"exception": str(e)}
-            continue
+    Апдейт только ставится в очередь чата; трейс "update" начинается при
+    постановке и закрывается, когда обработчик отработал в worker'е.
+    При переполнении очереди чата отбрасываются только апдейты, на которые
+    бот ответил бы: молча запоминаемые сообщения группы сохраняются всегда.
+    """
 
-    # Все модели не сработали
-    print(f"❌ Все модели недоступны. Последняя ошибка: {last_error}")
-    return f"⚠️ Все AI модели временно недоступны. Пожалуйста, попробуйте позже.\n\nПоследняя ошибка: {last_error}"
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+        await update_scheduler.run(chat.id, self._process, handler, event, data, chat, time.monotonic(),
+                                   droppable=await self._wants_reply(event))
+
+    @staticmethod
+    async def _wants_reply(event) -> bool:
+        """Ответит ли бот на апдейт (та же проверка, что в handler для групп)"""
+        if event.callback_query is not None:
+            return True
+        message = event.message
+        if message is None or not message.text:
+            return False
+        if message.chat.type == ChatType.PRIVATE or message.text.startswith("/"):
+            return True
+        identity = bot_identity or await get_bot_identity()
+        reply = message.reply_to_message
+        return (identity.mention.search(message.text) is not None or
+                (reply is not None and reply.from_user is not None and reply.from_user.id == identity.id))
+
+    @staticmethod
+    async def _process(handler, event, data, chat, queued_at: float):
+        span = tracer.span("update", root=True, update_id=event.update_id, chat_id=chat.id, chat_type=chat.type)
+        if span is not NO_SPAN:
+            # Трейс апдейта начинается с постановки в очередь
+            now = time.monotonic()
+            span.start = queued_at
+            span.trace.wall_start -= now - queued_at
+        with span:
+            tracer.record("queue", queued_at, time.monotonic())
+            await handler(event, data)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Замеряет время обработчиков сообщений и кнопок для метрик (по типу чата)"""
+
+    async def __call__(self, handler, event, data):
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            chat = data.get("event_chat")
+            handler_seconds.observe(time.monotonic() - started, chat.type if chat else "none")
+
+
+# Регистрируется после встроенного UserContextMiddleware, который кладёт event_chat в data
+dp.update.outer_middleware(ChatOrderMiddleware())
+dp.message.middleware(HandlerTimingMiddleware())
+dp.callback_query.middleware(HandlerTimingMiddleware())
 
 
 # -------------------------
@@ -779,7 +3877,8 @@ async def ask_ai_with_fallback(user_message: str, chat_id: int, reply_context: s
 
 @dp.message(Command("start"))
 async def start_handler(message: Message):
-    await message.answer(
+    await outbox.answer(
+        message,
         "Привет! Я теперь помню контекст, делаю сводки и отвечаю кратко, как человек.\n\n"
         "Используй /help чтобы увидеть все команды."
     )
@@ -796,6 +3895,8 @@ async def help_handler(message: Message):
 /stats - Показать статистику чата
 /model [название] - Посмотреть или сменить модель AI
 /style [название] - Посмотреть или сменить стиль общения
+/fallback [режим] - Как переключаться между моделями
+/coalesce [мс|on|off] - Отвечать на упоминания в группе пачкой
 
 🤖 Доступные модели (топ-3 для чатов):
 • deepseek - DeepSeek v3.1 Nex N1 (по умолчанию) ✅
@@ -815,40 +3916,65 @@ async def help_handler(message: Message):
 • флирт - Соблазнительный флирт +18
 • романтик - Страстный романтик +18
 • спорщик - Яростный дебатер +18
+
+🔀 Режимы fallback:
+• sequential - Следующая модель только после ошибки
+• hedged - Подстраховка, если модель долго молчит (по умолчанию)
+• race-all - Все модели сразу, самый быстрый ответ
 """
-    await message.answer(help_text)
+    await outbox.answer(message, help_text)
 
 
 @dp.message(Command("clear"))
 async def clear_handler(message: Message):
     chat_id = message.chat.id
-    clear_chat_memory(chat_id)
-    await message.answer("✅ Память чата очищена!")
+    await clear_chat_memory(chat_id)
+    await outbox.answer(message, "✅ Память чата очищена!")
 
 
 @dp.message(Command("stats"))
 async def stats_handler(message: Message):
     chat_id = message.chat.id
-    settings = get_chat_settings(chat_id)
-    memory_count = len(get_memory(chat_id))
-    summaries_count = count_summaries(chat_id)
-    messages_count = count_messages(chat_id)
+    settings, history, summary_levels, messages_count = await asyncio.gather(
+        get_chat_settings(chat_id),
+        get_memory(chat_id),
+        count_summaries(chat_id),
+        count_messages(chat_id),
+    )
+    memory_count = len(history)
 
     model_name = settings["model"]
     model_full = AVAILABLE_MODELS.get(model_name, "неизвестно")
     style_key = settings["style"]
     style_info = STYLE_PROMPTS.get(style_key, STYLE_PROMPTS[DEFAULT_STYLE])
+    mode_info = FALLBACK_MODES.get(settings["fallback_mode"], FALLBACK_MODES[DEFAULT_FALLBACK_MODE])
+    health_text = "\n".join(health.describe() for health in model_health.values())
+    coalesce_text = f"окно {settings['coalesce_ms']} мс" if settings["coalesce_ms"] else "выключена"
+    levels_text = " / ".join(str(summary_levels.get(level, 0)) for level in range(max(summary_levels, default=0) + 1))
 
     stats_text = f"""
 📊 Статистика чата:
 
-💾 Сообщений в памяти: {memory_count}
+💾 Сообщений в памяти: {memory_count} ({memory_buffer.chat_bytes(chat_id) / 1024:.1f} КБ)
+🧠 Память всех чатов: {memory_buffer.total_bytes / 1024 / 1024:.1f} МБ, чатов в RAM: {len(memory_buffer)}
+📥 Загрузок памяти из БД: {memory_buffer.db_loads} (из RAM: {memory_buffer.hits})
 💿 Всего сохранено в БД: {messages_count}
-📝 Сохранено сводок: {summaries_count}
+📝 Сохранено сводок: {sum(summary_levels.values())} (по уровням 0 / 1 / …: {levels_text}, слияний: {summary_queue.merges})
 🤖 Текущая модель: {model_name} ({model_full})
 🎨 Стиль общения: {style_info['name']} - {style_info['desc']}
+🔀 Режим fallback: {mode_info['name']}
+🔎 Поиск по долгосрочной памяти: {memory_index.describe()}
+🧩 Склейка упоминаний: {coalesce_text} (всего упоминаний {mention_coalescer.mentions} → запросов {mention_coalescer.requests})
+
+🩺 Состояние моделей:
+{health_text}
+
+🚦 Очередь апдейтов: в этом чате {update_scheduler.chat_depth(chat_id)}, всего {update_scheduler.pending}, ожидание ~{update_scheduler.wait_ewma * 1000:.0f} мс (макс {update_scheduler.wait_max * 1000:.0f} мс)
+📤 Отправка в Telegram: {outbox.sent} сообщений, повторов после RetryAfter {outbox.retries}, пропущено правок {outbox.dropped}
+🗃️ Кеш ответов: {response_cache.describe()}
+⚡ Кеш настроек: {settings_cache.hit_rate():.0%} попаданий ({settings_cache.hits}/{settings_cache.hits + settings_cache.misses})
 """
-    await message.answer(stats_text)
+    await outbox.answer(message, stats_text)
 
 
 @dp.message(Command("model"))
@@ -858,7 +3984,7 @@ async def model_handler(message: Message):
 
     if len(args) == 1:
         # Показать текущую модель с кнопками выбора
-        settings = get_chat_settings(chat_id)
+        settings = await get_chat_settings(chat_id)
         current_model = settings["model"]
         model_full = AVAILABLE_MODELS.get(current_model, "неизвестно")
 
@@ -878,7 +4004,8 @@ async def model_handler(message: Message):
 
         keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-        await message.answer(
+        await outbox.answer(
+            message,
             f"🤖 Текущая модель: {current_model}\n{model_full}\n\n"
             f"Выберите модель:",
             reply_markup=keyboard
@@ -888,12 +4015,12 @@ async def model_handler(message: Message):
         new_model = args[1].strip()
 
         if new_model in AVAILABLE_MODELS:
-            update_chat_setting(chat_id, "model", new_model)
+            await update_chat_setting(chat_id, "model", new_model)
             model_full = AVAILABLE_MODELS[new_model]
-            await message.answer(f"✅ Модель изменена на: {new_model} ({model_full})")
+            await outbox.answer(message, f"✅ Модель изменена на: {new_model} ({model_full})")
         else:
             models_list = ", ".join(AVAILABLE_MODELS.keys())
-            await message.answer(f"❌ Неизвестная модель. Доступные: {models_list}")
+            await outbox.answer(message, f"❌ Неизвестная модель. Доступные: {models_list}")
 
 
 @dp.message(Command("style"))
@@ -903,7 +4030,7 @@ async def style_handler(message: Message):
 
     if len(args) == 1:
         # Показать текущий стиль с кнопками выбора
-        settings = get_chat_settings(chat_id)
+        settings = await get_chat_settings(chat_id)
         current_style = settings["style"]
         current_info = STYLE_PROMPTS.get(current_style, STYLE_PROMPTS[DEFAULT_STYLE])
 
@@ -929,7 +4056,8 @@ async def style_handler(message: Message):
 
         keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-        await message.answer(
+        await outbox.answer(
+            message,
             f"🎨 Текущий стиль: {current_info['name']}\n"
             f"📝 {current_info['desc']}\n\n"
             f"Выберите стиль:",
@@ -940,32 +4068,117 @@ async def style_handler(message: Message):
         new_style = args[1].strip().lower()
 
         if new_style in STYLE_PROMPTS:
-            update_chat_setting(chat_id, "style", new_style)
+            await update_chat_setting(chat_id, "style", new_style)
             style_info = STYLE_PROMPTS[new_style]
-            await message.answer(
+            await outbox.answer(
+                message,
                 f"✅ Стиль изменён на: {style_info['name']}\n"
                 f"📝 {style_info['desc']}"
             )
         else:
             styles_list = ", ".join(STYLE_PROMPTS.keys())
-            await message.answer(f"❌ Неизвестный стиль. Доступные: {styles_list}")
+            await outbox.answer(message, f"❌ Неизвестный стиль. Доступные: {styles_list}")
+
+
+def fallback_keyboard(current_mode: str) -> InlineKeyboardMarkup:
+    """Кнопки выбора режима fallback"""
+    buttons = []
+    for key, info in FALLBACK_MODES.items():
+        button_text = info['name']
+        if key == current_mode:
+            button_text = f"✅ {button_text}"
+        buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"fallback:{key}")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.message(Command("fallback"))
+async def fallback_handler(message: Message):
+    chat_id = message.chat.id
+    args = message.text.split(maxsplit=1)
+
+    if len(args) == 1:
+        # Показать текущий режим с кнопками выбора
+        settings = await get_chat_settings(chat_id)
+        current_mode = settings["fallback_mode"]
+        current_info = FALLBACK_MODES.get(current_mode, FALLBACK_MODES[DEFAULT_FALLBACK_MODE])
+
+        await outbox.answer(
+            message,
+            f"🔀 Режим fallback: {current_info['name']}\n"
+            f"📝 {current_info['desc']}\n\n"
+            f"Выберите режим:",
+            reply_markup=fallback_keyboard(current_mode)
+        )
+    else:
+        # Сменить режим через текст
+        new_mode = args[1].strip().lower()
+
+        if new_mode in FALLBACK_MODES:
+            await update_chat_setting(chat_id, "fallback_mode", new_mode)
+            mode_info = FALLBACK_MODES[new_mode]
+            await outbox.answer(
+                message,
+                f"✅ Режим fallback изменён на: {mode_info['name']}\n"
+                f"📝 {mode_info['desc']}"
+            )
+        else:
+            modes_list = ", ".join(FALLBACK_MODES.keys())
+            await outbox.answer(message, f"❌ Неизвестный режим. Доступные: {modes_list}")
+
+
+@dp.message(Command("coalesce"))
+async def coalesce_handler(message: Message):
+    chat_id = message.chat.id
+    args = message.text.split(maxsplit=1)
+
+    if len(args) == 1:
+        settings = await get_chat_settings(chat_id)
+        current = settings["coalesce_ms"]
+        state = f"окно {current} мс" if current else "выключена"
+        await outbox.answer(
+            message,
+            f"🧩 Склейка упоминаний: {state}\n\n"
+            f"Упоминания бота, пришедшие за окно или пока он отвечает, "
+            f"получают один общий ответ.\n"
+            f"/coalesce on - включить ({COALESCE_DEFAULT_MS} мс)\n"
+            f"/coalesce 3000 - своё окно в мс (до {COALESCE_MAX_MS})\n"
+            f"/coalesce off - выключить"
+        )
+        return
+
+    value = args[1].strip().lower()
+    if value == "on":
+        window = COALESCE_DEFAULT_MS
+    elif value == "off":
+        window = 0
+    elif value.isdigit() and int(value) <= COALESCE_MAX_MS:
+        window = int(value)
+    else:
+        await outbox.answer(message, f"❌ Укажи on, off или окно в мс от 0 до {COALESCE_MAX_MS}")
+        return
+
+    await update_chat_setting(chat_id, "coalesce_ms", window)
+    if window:
+        await outbox.answer(message, f"✅ Склейка упоминаний включена, окно {window} мс")
+    else:
+        await outbox.answer(message, "✅ Склейка упоминаний выключена")
 
 
 # Обработчик нажатий на inline кнопки
-@dp.callback_query(lambda c: c.data.startswith(('model:', 'style:')))
+@dp.callback_query(lambda c: c.data.startswith(('model:', 'style:', 'fallback:')))
 async def callback_handler(callback: CallbackQuery):
     chat_id = callback.message.chat.id
     data_parts = callback.data.split(':')
-    setting_type = data_parts[0]  # 'model' или 'style'
+    setting_type = data_parts[0]  # 'model', 'style' или 'fallback'
     setting_value = data_parts[1]
 
     if setting_type == 'model':
         if setting_value in AVAILABLE_MODELS:
-            update_chat_setting(chat_id, "model", setting_value)
+            await update_chat_setting(chat_id, "model", setting_value)
             model_full = AVAILABLE_MODELS[setting_value]
 
             # Обновляем сообщение с новыми кнопками
-            settings = get_chat_settings(chat_id)
+            settings = await get_chat_settings(chat_id)
             current_model = settings["model"]
 
             buttons = []
@@ -983,7 +4196,8 @@ async def callback_handler(callback: CallbackQuery):
 
             keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-            await callback.message.edit_text(
+            await outbox.edit(
+                callback.message,
                 f"🤖 Текущая модель: {current_model}\n{model_full}\n\n"
                 f"Выберите модель:",
                 reply_markup=keyboard
@@ -992,11 +4206,11 @@ async def callback_handler(callback: CallbackQuery):
 
     elif setting_type == 'style':
         if setting_value in STYLE_PROMPTS:
-            update_chat_setting(chat_id, "style", setting_value)
+            await update_chat_setting(chat_id, "style", setting_value)
             style_info = STYLE_PROMPTS[setting_value]
 
             # Обновляем сообщение с новыми кнопками
-            settings = get_chat_settings(chat_id)
+            settings = await get_chat_settings(chat_id)
             current_style = settings["style"]
             current_info = STYLE_PROMPTS.get(current_style, STYLE_PROMPTS[DEFAULT_STYLE])
 
@@ -1019,7 +4233,8 @@ async def callback_handler(callback: CallbackQuery):
 
             keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-            await callback.message.edit_text(
+            await outbox.edit(
+                callback.message,
                 f"🎨 Текущий стиль: {current_info['name']}\n"
                 f"📝 {current_info['desc']}\n\n"
                 f"Выберите стиль:",
@@ -1027,6 +4242,20 @@ async def callback_handler(callback: CallbackQuery):
             )
             await callback.answer(f"✅ Стиль изменён на {style_info['name']}")
 
+    elif setting_type == 'fallback':
+        if setting_value in FALLBACK_MODES:
+            await update_chat_setting(chat_id, "fallback_mode", setting_value)
+            mode_info = FALLBACK_MODES[setting_value]
+
+            await outbox.edit(
+                callback.message,
+                f"🔀 Режим fallback: {mode_info['name']}\n"
+                f"📝 {mode_info['desc']}\n\n"
+                f"Выберите режим:",
+                reply_markup=fallback_keyboard(setting_value)
+            )
+            await callback.answer(f"✅ Режим изменён на {mode_info['name']}")
+
 
 @dp.message()
 async def handler(message: Message):
@@ -1044,17 +4273,24 @@ async def handler(message: Message):
     # --------------------------
     if message.chat.type == ChatType.PRIVATE:
 
-        add_to_memory(chat_id, "user", f"{username}: {message.text}", message.date)
+        with tracer.span("add_to_memory"):
+            await add_to_memory(chat_id, "user", f"{username}: {message.text}", message.date)
 
-        reply = await ask_ai_with_fallback(message.text, chat_id, reply_context)
+        with tracer.span("reply", stream=STREAM_REPLIES):
+            if STREAM_REPLIES:
+                reply = await stream_ai_reply(message, message.text, chat_id, reply_context)
+            else:
+                reply = await ask_ai_with_fallback(message.text, chat_id, reply_context)
+                await outbox.answer(message, reply)
 
-        add_to_memory(chat_id, "assistant", f"Бот: {reply}", datetime.now(timezone.utc))
+        with tracer.span("add_to_memory"):
+            await add_to_memory(chat_id, "assistant", f"Бот: {reply}", datetime.now(timezone.utc))
 
-        # если переписка разрослась — делаем summary
-        if len(get_memory(chat_id)) > MAX_MEMORY:
-            await summarize_chat(chat_id)
+        # если переписка разрослась — делаем summary в фоне
+        if len(await get_memory(chat_id)) > MAX_MEMORY:
+            summary_queue.schedule(chat_id)
 
-        return await message.answer(reply)
+        return
 
 
     # --------------------------
@@ -1065,38 +4301,148 @@ async def handler(message: Message):
         if not message.text:
             return
 
-        bot_username = (await bot.get_me()).username.lower()
-        bot_id = (await bot.get_me()).id
+        identity = bot_identity or await get_bot_identity()
 
         # Добавляем ВСЕ сообщения в память (для контекста переписки)
-        add_to_memory(chat_id, "user", f"{username}: {message.text}", message.date)
+        with tracer.span("add_to_memory"):
+            await add_to_memory(chat_id, "user", f"{username}: {message.text}", message.date)
 
         # Проверяем два условия для ответа:
         # 1. Упоминание @bot_username
         # 2. Реплай на сообщение бота
-        is_mentioned = f"@{bot_username}" in message.text.lower()
+        is_mentioned = identity.mention.search(message.text) is not None
         is_reply_to_bot = (message.reply_to_message and
-                          message.reply_to_message.from_user.id == bot_id)
+                          message.reply_to_message.from_user.id == identity.id)
 
         # Отвечаем если упомянули ИЛИ это реплай на сообщение бота
         if is_mentioned or is_reply_to_bot:
             # Убираем упоминание для чистого запроса к AI (если оно есть)
-            clean_text = message.text.replace(f"@{bot_username}", "").strip()
+            clean_text = identity.mention.sub("", message.text).strip()
 
-            reply = await ask_ai_with_fallback(clean_text, chat_id, reply_context)
+            # Со склейкой ответ придёт позже, общий на все упоминания из окна
+            settings = await get_chat_settings(chat_id)
+            if settings["coalesce_ms"]:
+                mention_coalescer.submit(message, username, clean_text, reply_context,
+                                         settings["coalesce_ms"] / 1000)
+                return
 
-            add_to_memory(chat_id, "assistant", f"Бот: {reply}", datetime.now(timezone.utc))
+            await answer_in_group(message, clean_text, chat_id, reply_context)
+            return
 
-            # если память большая — делаем summary
-            if len(get_memory(chat_id)) > MAX_MEMORY:
-                await summarize_chat(chat_id)
+        # Если бота не упомянули и это не реплай - просто запомнили сообщение, не отвечаем
+        # Периодически делаем summary для общего контекста (в фоне)
+        if len(await get_memory(chat_id)) > MAX_MEMORY:
+            summary_queue.schedule(chat_id)
 
-            return await message.reply(reply)
 
-        # Если бота не упомянули и это не реплай - просто запомнили сообщение, не отвечаем
-        # Периодически делаем summary для общего контекста
-        if len(get_memory(chat_id)) > MAX_MEMORY:
-            await summarize_chat(chat_id)
+# -------------------------
+#          ВЕБХУК
+# -------------------------
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")                           # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                                # публичный адрес, напр. https://bot.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")                          # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8080")))  # Railway задаёт PORT сам
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))     # апдейтов в очереди на обработку
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))             # задач, разбирающих очередь вебхука (обработка — в очередях чатов)
+WEBHOOK_DRAIN_TIMEOUT = 10.0                                          # сек на дообработку очереди при остановке
+
+webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+
+async def webhook_handler(request: web.Request) -> web.Response:
+    """
+    Принимает апдейт от Telegram и сразу отвечает 200.
+
+    Сам апдейт обрабатывается воркерами из webhook_queue. Если очередь
+    полна, отвечаем 503 — Telegram повторит доставку позже.
+    """
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+    ):
+        return web.Response(status=401)
+
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except ValueError:
+        return web.Response(status=400)
+
+    try:
+        webhook_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        return web.Response(status=503)
+
+    return web.Response()
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def webhook_worker():
+    while True:
+        update = await webhook_queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            print(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            webhook_queue.task_done()
+
+
+async def run_webhook():
+    """
+    Принимает апдейты через aiohttp сервер вместо long polling.
+
+    Работает, пока задачу не отменят; при отмене перестаёт принимать
+    запросы и даёт воркерам дообработать очередь. Без WEBHOOK_URL вебхук
+    в Telegram не регистрируется — так сервер удобно проверять локально,
+    отправляя записанные апдейты POST запросом на WEBHOOK_PATH.
+    """
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.router.add_get("/", health_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    workers = [asyncio.create_task(webhook_worker()) for _ in range(WEBHOOK_WORKERS)]
+    print(f"✅ Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        if WEBHOOK_URL:
+            if not WEBHOOK_SECRET:
+                print("⚠️  WEBHOOK_SECRET не задан: запросы к вебхуку не проверяются")
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        else:
+            print("⚠️  WEBHOOK_URL не задан: вебхук в Telegram не регистрируется (локальный режим)")
+
+        await asyncio.Event().wait()
+
+    finally:
+        # Новые апдейты не принимаем, уже принятые дообрабатываем
+        await runner.cleanup()
+        try:
+            await asyncio.wait_for(webhook_queue.join(), timeout=drain_timeout(WEBHOOK_DRAIN_TIMEOUT))
+        except asyncio.TimeoutError:
+            print(f"⚠️  Не успели обработать {webhook_queue.qsize()} апдейтов из очереди")
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def run_polling():
+    # Вебхук, оставшийся от запуска в режиме webhook, мешает getUpdates
+    await bot.delete_webhook()
+    # Сигналы ловит main(): со своими обработчиками aiogram остановил бы поллинг в обход сохранения памяти.
+    # Сессию бота закрывает main() — после поллинга ещё дописываются ответы из очередей
+    await dp.start_polling(bot, handle_signals=False, close_bot_session=False)
 
 
 # -------------------------
@@ -1105,9 +4451,18 @@ async def handler(message: Message):
 
 # Глобальная переменная для отслеживания запроса на остановку
 shutdown_event = asyncio.Event()
+# loop.time(), к которому должна закончиться вся остановка (дообработка и сводки); None — не останавливаемся
+shutdown_deadline = None
+
+
+def drain_timeout(limit: float) -> float:
+    """Сколько ждать дообработки очереди: не больше limit и не позже общего дедлайна остановки"""
+    if shutdown_deadline is None:
+        return limit
+    return max(0.0, min(limit, shutdown_deadline - asyncio.get_running_loop().time()))
 
 
-def signal_handler(signum, frame):
+def signal_handler(signum):
     """Обработчик системных сигналов (SIGTERM, SIGINT)"""
     print(f"\n🛑 Получен сигнал {signum}. Инициирую graceful shutdown...")
     shutdown_event.set()
@@ -1122,26 +4477,100 @@ async def set_bot_commands():
         BotCommand(command="stats", description="Показать статистику"),
         BotCommand(command="model", description="Посмотреть/сменить модель AI"),
         BotCommand(command="style", description="Посмотреть/сменить стиль общения"),
+        BotCommand(command="fallback", description="Режим переключения между моделями"),
+        BotCommand(command="coalesce", description="Общий ответ на упоминания в группе"),
     ]
     await bot.set_my_commands(commands)
     print("✅ Команды бота зарегистрированы")
 
 
+async def drain_updates(timeout: float):
+    """
+    Дообрабатывает принятые апдейты и упоминания (не дольше timeout) и
+    останавливает update_scheduler и mention_coalescer.
+
+    Обработчики из очереди чата докладывают упоминания в склейку, а склейка
+    отвечает через очередь чата, поэтому ждём, пока не стихнет и то и другое.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (update_scheduler.pending or mention_coalescer.busy()) and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    await mention_coalescer.stop(0)
+    await update_scheduler.stop(0)
+
+
+async def shutdown(polling_task):
+    """
+    Остановка: отметки «ждёт summary», конец приёма апдейтов, дообработка
+    очередей и сводки — всё в пределах SHUTDOWN_DEADLINE.
+    """
+    global shutdown_deadline
+    shutdown_deadline = asyncio.get_running_loop().time() + SHUTDOWN_DEADLINE
+
+    # Отметки «ждёт summary» — до любого ожидания, чтобы пережить SIGKILL
+    await mark_pending_memories()
+
+    if polling_task is not None:
+        print("🔄 Останавливаю поллинг...")
+        if BOT_MODE != "webhook" and not polling_task.done():
+            # Отмена задачи оставила бы внутренние задачи поллинга aiogram работать
+            await dp.stop_polling()
+        polling_task.cancel()
+        try:
+            await polling_task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    # Дообрабатываем уже принятые апдейты и упоминания
+    await drain_updates(drain_timeout(SCHEDULER_DRAIN_TIMEOUT))
+
+    # Сохраняем всю память перед завершением
+    await save_all_memories(shutdown_deadline)
+
+
 async def main():
     logging.basicConfig(level=logging.INFO)
 
-    # Регистрируем обработчики сигналов
-    signal.signal(signal.SIGTERM, signal_handler)  # Railway отправляет SIGTERM при остановке
-    signal.signal(signal.SIGINT, signal_handler)   # Ctrl+C локально
+    # Регистрируем обработчики сигналов (в event loop, чтобы сигнал сразу будил ожидание остановки)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, signal_handler, signal.SIGTERM)  # Railway отправляет SIGTERM при остановке
+    loop.add_signal_handler(signal.SIGINT, signal_handler, signal.SIGINT)    # Ctrl+C локально
 
     # Регистрируем команды бота
     await set_bot_commands()
 
+    # Узнаём id и username бота один раз (для упоминаний в группах)
+    identity = await get_bot_identity()
+    print(f"✅ Бот @{identity.username} (id {identity.id})")
+
+    # Фоновая пакетная запись сообщений в БД
+    message_writer.start()
+
+    # Общий keep-alive клиент OpenRouter
+    openrouter.start()
+
+    # Фоновая проверка отключённых моделей
+    probe_task = asyncio.create_task(breaker_probe_loop())
+
+    # Фоновая очередь summary
+    summary_queue.start()
+
+    # Досворачиваем чаты, не успевшие при прошлой остановке
+    resume_task = asyncio.create_task(resume_pending_summaries())
+
+    # Метрики Prometheus на локальном порту
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+
     print("✅ Бот запущен. Нажмите Ctrl+C для остановки.")
 
+    polling_task = None
     try:
-        # Запускаем поллинг в отдельной задаче
-        polling_task = asyncio.create_task(dp.start_polling(bot))
+        # Запускаем поллинг (или вебхук, если BOT_MODE=webhook) в отдельной задаче
+        if BOT_MODE == "webhook":
+            polling_task = asyncio.create_task(run_webhook())
+        else:
+            polling_task = asyncio.create_task(run_polling())
 
         # Ждём сигнала остановки или завершения поллинга
         await asyncio.wait(
@@ -1149,29 +4578,40 @@ async def main():
             return_when=asyncio.FIRST_COMPLETED
         )
 
-        # Если получен сигнал остановки
-        if shutdown_event.is_set():
-            print("🔄 Останавливаю поллинг...")
-            polling_task.cancel()
-
-            try:
-                await polling_task
-            except asyncio.CancelledError:
-                pass
-
-            # Сохраняем всю память перед завершением
-            await save_all_memories()
+        # Остановка одна и та же, по сигналу или если поллинг завершился сам (например, упал)
+        if not shutdown_event.is_set():
+            error = polling_task.exception()
+            print(f"⚠️  Приём апдейтов остановился{f': {error}' if error else ''}. Сохраняю память...")
 
     except KeyboardInterrupt:
         print("\n🛑 KeyboardInterrupt. Сохраняю память...")
-        await save_all_memories()
 
     except Exception as e:
         print(f"❌ Неожиданная ошибка: {e}")
-        await save_all_memories()
 
     finally:
+        # На любом выходе: дообработка очередей и сводки — до закрытия БД
+        try:
+            await shutdown(polling_task)
+        except Exception as e:
+            print(f"❌ Ошибка при остановке: {e}")
+
+        probe_task.cancel()
+        resume_task.cancel()
+
+        # Дописываем в БД сообщения, накопленные в очереди
+        try:
+            await message_writer.stop()
+        except Exception as e:
+            print(f"❌ Не удалось дописать сообщения в БД: {e}")
+
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await openrouter.close()
         await bot.session.close()
+        # Дожидаемся незавершённых записей и закрываем соединения с БД
+        storage.close()
+        tracer.close()
         print("👋 Бот остановлен.")
 
 